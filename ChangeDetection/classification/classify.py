@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+import argparse
 import os
 import sys
 
@@ -7,16 +9,34 @@ import pickle
 import numpy as np
 
 sys.path.insert(0, "../util/")
-from arr_to_gtiff import arr_to_gtiff
+from arr_to_gtiff import gtiff_to_cog
+from db_encoding import band_encoding, read_window
+from s3_output import output_path, remove_output, upload_output
+from gnb_kernel import fast_model
+from lut_classifier import LUTClassifier, accuracy_report, print_report
+from shared_model import attach_model, can_share, share_model
+from granule_pool import run_granules
 
 bucket = "processed-granules"
 s3 = boto3.client('s3')
 
 classifier = "s1_classifier_nb_all_vv-vh.pkl"
 mode = "nb_all"
+bands = ['VV', 'VH']
 
+# set up by init_worker in each worker process
+worker_model = None
+worker_shm = None   # shared memory the model's parameters are in, if shared
+worker_samples = 0  # valid pixels to sample per granule (see classify)
 
-def classify(file, bands, model):
+
+""" Classify a granule one window of rows at a time: read the bands of the window, predict only its valid pixels,
+    and write the result straight into the output raster, so memory use depends on block_rows rather than on the
+    size of the granule. The next window is read while the current one is classified. Returns the number of pixels,
+    classified (valid) pixels and forest (nonzero class) pixels of the granule. If samples is set, also returns
+    about that many of its valid pixels (n x bands, spread evenly over the granule) as 'sample', e.g. to compare a
+    LUTClassifier with its model on real pixels. """
+def classify(file, bands, model, block_rows=512, samples=0):
     basename = os.path.basename(file)
     print(f"Generating forest mask for {file}...")
 
@@ -24,41 +44,116 @@ def classify(file, bands, model):
     for band in bands:
         files.append(f"/vsis3/{file}/{basename}_{band}_FILTERED.tif")
 
-    original_shape = None
-    imgs = []
-    for i in range(0, len(files)):
-        ds = gdal.Open(files[i])
-        arr = ds.GetRasterBand(1).ReadAsArray()
-        if not original_shape:
-            original_shape = arr.shape
-        imgs.append(arr.reshape(-1))
-        ds = None
-    
-    # drop all nan values
-    data = np.column_stack(imgs)
-    length = data.shape[0]
-    mask = np.all(np.logical_not(np.isnan(data)), axis=1)
-    
-    test_data = data[mask]
-    preds = model.predict(test_data)
-    classified = np.full((length,), np.nan, dtype=np.float32)
-    classified[mask] = preds
-    classified = classified.reshape(original_shape)
-    
-    outname = f"{basename}_FMASK_{mode}.tif"
-    arr_to_gtiff(classified, outname, files[0], dtype=gdal.GDT_Int16)
+    datasets = [gdal.Open(band_file) for band_file in files]
+    rasters = [ds.GetRasterBand(1) for ds in datasets]
+    # decodes uint16 dB outputs back to linear gamma0
+    encodings = [band_encoding(raster) for raster in rasters]
+    xsize = datasets[0].RasterXSize
+    ysize = datasets[0].RasterYSize
+
+    # read whole rows of blocks, so every tile of the inputs is read once
+    block_ysize = rasters[0].GetBlockSize()[1]
+    block_rows = max(block_ysize, block_rows // block_ysize * block_ysize)
+
+    # write the mask to a tiled geotiff as it's classified, and convert it to a COG at the end
+    part = output_path(f"{basename}_FMASK_{mode}.part.tif", xsize * ysize * 2)
+    out_ds = gdal.GetDriverByName("GTiff").Create(part, xsize, ysize, 1, gdal.GDT_Int16,
+                                                  options=["TILED=YES", "BLOCKXSIZE=512", "BLOCKYSIZE=512",
+                                                           "COMPRESS=DEFLATE", "BIGTIFF=IF_SAFER"])
+    out_ds.SetGeoTransform(datasets[0].GetGeoTransform())
+    out_ds.SetProjection(datasets[0].GetProjection())
+    outband = out_ds.GetRasterBand(1)
+
+    def read_rows(yoff):
+        nrows = min(block_rows, ysize - yoff)
+        return [read_window(raster, 0, yoff, xsize, nrows, encoding) for raster, encoding in zip(rasters, encodings)]
+
+    rows = list(range(0, ysize, block_rows))
+    counts = {'pixels': xsize * ysize, 'classified': 0, 'forest': 0}
+    sample_step = max(1, xsize * ysize // samples) if samples else 0
+    sample = []
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        # gdal releases the GIL while reading, so the next window is read during prediction
+        next_imgs = reader.submit(read_rows, rows[0])
+        for i, yoff in enumerate(rows):
+            imgs = next_imgs.result()
+            if i + 1 < len(rows):
+                next_imgs = reader.submit(read_rows, rows[i + 1])
+            classified, valid, block_sample = classify_block(imgs, model, sample_step)
+            outband.WriteArray(classified, 0, yoff)
+            if block_sample is not None:
+                sample.append(block_sample)
+            counts['classified'] += valid
+            counts['forest'] += np.count_nonzero(classified)
+
+    out_ds = outband = datasets = rasters = None
+    outname = output_path(f"{basename}_FMASK_{mode}.tif", xsize * ysize * 2)
+    gtiff_to_cog(part, outname, categorical=True)
+    remove_output(part)
 
     # upload to s3
     bucket = "classified-granules"
     _, key = file.split('/', 1)
     key = f"{key}_FMASK_{mode}.tif"
-    s3.upload_file(outname, bucket, key)
+    upload_output(outname, bucket, key, s3)
     print(f"Uploaded {key} to {bucket}.")
-    os.remove(outname)
-    
+    if samples:
+        counts['sample'] = np.concatenate(sample) if sample else np.empty((0, len(bands)), dtype=np.float32)
+    return counts
+
+
+""" Classify the pixels of a window (one array per band). Pixels that are NaN in any band are 0, like GDAL's
+    conversion of NaN to int16 made them before. Also returns the number of valid pixels, and every sample_step-th
+    valid pixel (n x bands) if sample_step is set, otherwise None. """
+def classify_block(imgs, model, sample_step=0):
+    # drop all nan values
+    mask = np.logical_not(np.isnan(imgs[0]))
+    for img in imgs[1:]:
+        mask &= np.logical_not(np.isnan(img))
+
+    classified = np.zeros(imgs[0].shape, dtype=np.int16)
+    sample = None
+    if mask.any():
+        test_data = np.empty((np.count_nonzero(mask), len(imgs)), dtype=np.float32)
+        for i, img in enumerate(imgs):
+            test_data[:, i] = img[mask]
+        classified[mask] = model.predict(test_data)
+        if sample_step:
+            sample = test_data[::sample_step].copy()
+    return classified, np.count_nonzero(mask), sample
+
+
+""" Set up a worker: use model, or attach to a model in shared memory (see shared_model). samples is the number of
+    valid pixels of each granule to return (see classify). """
+def init_worker(model=None, model_spec=None, samples=0):
+    global s3, worker_model, worker_shm, worker_samples
+    s3 = boto3.client('s3')
+    worker_samples = samples
+    if model_spec:
+        worker_shm, worker_model = attach_model(model_spec)
+    else:
+        worker_model = model
+
+
+def classify_granule(file):
+    return classify(file, bands, worker_model, samples=worker_samples)
 
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="Generate forest masks for the filtered Sentinel-1 granules in s3.")
+    parser.add_argument("--lut", action="store_true",
+                        help="classify pixels by looking up their quantized VV/VH values in a table of the "
+                             "classifier's predictions, computed once (see lut_classifier.py)")
+    parser.add_argument("--lut-size", type=int, default=4096,
+                        help="number of cells per band of the lookup table (default: 4096)")
+    parser.add_argument("--lut-samples", type=int, default=100_000,
+                        help="with --lut, number of valid pixels of each granule to also classify with the "
+                             "classifier, to report how often the table differs from it (default: 100000)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of granules to classify in parallel, in separate processes (default: 1)")
+    args = parser.parse_args()
+
     files = []
     for file in s3.list_objects(Bucket=bucket, Prefix='s1/77/1191/2021')['Contents']:
         # we have vv and vh both stored in a single folder. we want to process them at the same time
@@ -70,9 +165,34 @@ def main():
     with open(classifier, 'rb') as clf:
         model = pickle.load(clf)
     
-    bands = ['VV', 'VH']
-    for file in files:
-        classify(file, bands, model)
+    samples = 0
+    if args.lut:
+        lut = LUTClassifier(model, args.lut_size)
+        classifier_model, model = model, lut
+        samples = args.lut_samples
+    else:
+        # two-class GaussianNB models are evaluated with the float32 kernel in gnb_kernel
+        model = fast_model(model)
+    
+    # the model's parameters are put in shared memory once, instead of being
+    # pickled to every worker. other models are pickled once per worker
+    shm = None
+    initargs = (model, None, samples)
+    if args.workers > 1 and can_share(model):
+        shm, spec = share_model(model)
+        initargs = (None, spec, samples)
+    try:
+        results = run_granules(files, classify_granule, args.workers, init_worker, initargs)
+    finally:
+        if shm:
+            shm.close()
+            shm.unlink()
+
+    # compare the table with the classifier on the sampled pixels of all granules
+    if samples:
+        sampled = [result['sample'] for result in results if len(result.get('sample', ()))]
+        if sampled:
+            print_report(accuracy_report(model, classifier_model, X=np.concatenate(sampled)), args.lut_size)
     
 
 if __name__ == "__main__":
@@ -1,3 +1,4 @@
+import argparse
 import os
 import sys
 
@@ -7,6 +8,9 @@ import boto3
 
 sys.path.insert(0, "../util/")
 from arr_to_gtiff import arr_to_gtiff
+from db_encoding import read_band
+from s3_output import output_path, upload_output
+from granule_pool import run_granules
 
 
 s3 = boto3.client('s3')
@@ -15,6 +19,7 @@ s3 = boto3.client('s3')
 # Basic version of s1 classifier.
 # Fast, but untrained and not very accurate. 
 # Thresholds set via a best guess.
+# Returns the number of pixels, classified (valid) pixels and forest pixels.
 def gen_fmask(file):
     basename = os.path.basename(file)
     print(f"Generating forest mask for {file}...")
@@ -26,32 +31,43 @@ def gen_fmask(file):
     # open datasets
     vv_tif = f"/vsis3/{file}/{basename}_VV_FILTERED.tif"
     vh_tif = f"/vsis3/{file}/{basename}_VH_FILTERED.tif"
-    vv_ds = gdal.Open(vv_tif)
-    vh_ds = gdal.Open(vh_tif)
-    vv = vv_ds.GetRasterBand(1).ReadAsArray().astype(np.float32)
-    vh = vh_ds.GetRasterBand(1).ReadAsArray().astype(np.float32)
+    # decodes uint16 dB outputs back to linear gamma0
+    vv = read_band(vv_tif)
+    vh = read_band(vh_tif)
 
     # generate fmasks
     mask = np.logical_and(vv > vv_threshold, vh > vh_threshold).astype(np.int16)
+    counts = {'pixels': mask.size,
+              'classified': np.count_nonzero(np.logical_not(np.isnan(vv) | np.isnan(vh))),
+              'forest': np.count_nonzero(mask)}
     mask = np.where(mask, mask, np.nan)
     
     # write to file
-    outname = f"{basename}_FMASK.tif"
+    outname = output_path(f"{basename}_FMASK.tif", mask.nbytes)
     arr_to_gtiff(mask, outname, vv_tif, dtype=gdal.GDT_Int16)
 
-    # flush cache so gdal writes properly
-    vv_ds = vh_ds = None
-
     # upload to s3
     bucket = "classified-granules"
     _, key = file.split('/', 1)
     key = f"{key}_FMASK.tif"
-    s3.upload_file(outname, bucket, key)
+    upload_output(outname, bucket, key, s3)
     print(f"Uploaded {key} to {bucket}.")
-    os.remove(outname)
+    return counts
+
+
+# Set up a worker process
+def init_worker():
+    global s3
+    s3 = boto3.client('s3')
     
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="Generate threshold forest masks for the filtered Sentinel-1 granules in s3.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of granules to process in parallel, in separate processes (default: 1)")
+    args = parser.parse_args()
+
     bucket = "processed-granules"
     files = []
     for file in s3.list_objects(Bucket=bucket, Prefix='s1')['Contents']:
@@ -61,8 +77,7 @@ def main():
         if file not in files:
             files.append(file)
 
-    for file in files:
-        gen_fmask(file)
+    run_granules(files, gen_fmask, args.workers, init_worker)
         
 
 
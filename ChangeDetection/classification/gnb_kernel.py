@@ -0,0 +1,122 @@
+import argparse
+import pickle
+import sys
+
+import numpy as np
+
+
+""" Closed-form float32 inference for two-class GaussianNB models.
+
+    With two classes, predict() only needs the sign of the log-likelihood
+    ratio of class 1 over class 0, which for Gaussian features is a quadratic
+    in each feature:
+
+        d(x) = sum_j (a_j * x_j + b_j) * x_j + c
+        a_j = (1/var_0j - 1/var_1j) / 2
+        b_j = theta_1j/var_1j - theta_0j/var_0j
+        c   = log(prior_1/prior_0) - sum_j log(var_1j/var_0j) / 2
+              - sum_j (theta_1j^2/var_1j - theta_0j^2/var_0j) / 2
+
+    The coefficients are computed once (in float64) from theta_, var_ and
+    class_prior_, and d(x) is evaluated in float32 without sklearn's input
+    validation, float64 upcast or per-class likelihood arrays. Results can
+    only differ from model.predict for pixels within float32 rounding of the
+    decision boundary (see check_parity). """
+class GaussianNBKernel:
+    def __init__(self, model):
+        theta = np.asarray(model.theta_, dtype=np.float64)
+        # older sklearn versions call var_ sigma_
+        var = np.asarray(model.var_ if hasattr(model, "var_") else model.sigma_, dtype=np.float64)
+        prior = np.asarray(model.class_prior_, dtype=np.float64)
+
+        self.classes = model.classes_
+        self.a = ((1 / var[0] - 1 / var[1]) / 2).astype(np.float32)
+        self.b = (theta[1] / var[1] - theta[0] / var[0]).astype(np.float32)
+        self.c = np.float32(np.log(prior[1] / prior[0]) - np.sum(np.log(var[1] / var[0])) / 2
+                            - np.sum(theta[1]**2 / var[1] - theta[0]**2 / var[0]) / 2)
+
+    """ Parameters of the kernel as arrays (see shared_model). """
+    def to_arrays(self):
+        return {'a': self.a, 'b': self.b, 'c': np.asarray(self.c), 'classes': np.asarray(self.classes)}
+
+    """ Kernel using the given parameter arrays (from to_arrays) without copying them. """
+    @classmethod
+    def from_arrays(cls, arrays):
+        kernel = cls.__new__(cls)
+        kernel.a = arrays['a']
+        kernel.b = arrays['b']
+        kernel.c = arrays['c'][()]
+        kernel.classes = arrays['classes']
+        return kernel
+
+    """ Log-likelihood ratio of class 1 over class 0 for each row of X
+        (n_samples x n_features). """
+    def decision_function(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        d = np.full(X.shape[0], self.c, dtype=np.float32)
+        term = np.empty(X.shape[0], dtype=np.float32)
+        for j in range(X.shape[1]):
+            x = X[:, j]
+            np.multiply(x, self.a[j], out=term)
+            term += self.b[j]
+            term *= x
+            d += term
+        return d
+
+    """ Same as model.predict(X). Ties go to class 0, like sklearn's argmax.
+        Rows with NaN (which model.predict rejects) also get class 0. """
+    def predict(self, X):
+        return self.classes[(self.decision_function(X) > 0).astype(np.intp)]
+
+    """ Same as model.predict_proba(X) (up to float32 rounding): the columns are
+        the probabilities of class 0 and class 1, the latter the sigmoid of
+        decision_function. Rows with NaN (which model.predict_proba rejects)
+        get NaN probabilities. """
+    def predict_proba(self, X):
+        with np.errstate(invalid='ignore'):
+            p1 = np.exp(-np.logaddexp(np.float32(0), -self.decision_function(X)))
+        return np.column_stack([1 - p1, p1])
+
+
+""" Return a fast predictor for model (anything with a predict method): a
+    GaussianNBKernel if model is a two-class GaussianNB, otherwise model. """
+def fast_model(model):
+    if type(model).__name__ == "GaussianNB" and len(model.classes_) == 2:
+        return GaussianNBKernel(model)
+    return model
+
+
+""" Compare GaussianNBKernel with model.predict on n random samples spread
+    over +-4 standard deviations of every class. Returns the fraction of
+    samples where they disagree. """
+def check_parity(model, n=1_000_000, seed=0):
+    kernel = GaussianNBKernel(model)
+    var = model.var_ if hasattr(model, "var_") else model.sigma_
+    rng = np.random.default_rng(seed)
+    lo = np.min(model.theta_ - 4 * np.sqrt(var), axis=0)
+    hi = np.max(model.theta_ + 4 * np.sqrt(var), axis=0)
+    X = rng.uniform(lo, hi, size=(n, model.theta_.shape[1])).astype(np.float32)
+    return np.mean(kernel.predict(X) != model.predict(X))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check that the float32 GaussianNB kernel predicts the same classes as a pickled classifier.")
+    parser.add_argument("classifier", nargs="?", default="s1_classifier_nb_all_vv-vh.pkl",
+                        help="pickled two-class GaussianNB (default: s1_classifier_nb_all_vv-vh.pkl)")
+    parser.add_argument("--samples", type=int, default=1_000_000,
+                        help="number of random samples to compare (default: 1000000)")
+    parser.add_argument("--tolerance", type=float, default=1e-5,
+                        help="largest fraction of samples allowed to differ (default: 1e-5)")
+    args = parser.parse_args()
+
+    with open(args.classifier, 'rb') as clf:
+        model = pickle.load(clf)
+
+    mismatch = check_parity(model, args.samples)
+    print(f"{mismatch * args.samples:.0f}/{args.samples} samples differ ({mismatch:.2e})")
+    sys.exit(0 if mismatch <= args.tolerance else 1)
+
+
+if __name__ == "__main__":
+    main()
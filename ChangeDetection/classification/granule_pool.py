@@ -0,0 +1,54 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import time
+
+
+# Run func(file) for every granule directory, in a pool of workers processes
+# (or one after the other in this process if workers is 1). initializer(*initargs)
+# sets up the state func needs, in every worker. func returns a dict of pixel
+# counts of the granule. Returns one row per granule with its status, time
+# and pixel counts, and prints them as a table.
+def run_granules(files, func, workers=1, initializer=None, initargs=()):
+    start = time.time()
+    results = []
+    if workers <= 1:
+        if initializer:
+            initializer(*initargs)
+        for file in files:
+            results.append(run_granule(func, file))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+            futures = [executor.submit(run_granule, func, file) for file in files]
+            for future in as_completed(futures):
+                results.append(future.result())
+                print(f"[{len(results)}/{len(futures)}] {results[-1]['status']} {results[-1]['granule']}")
+
+    print_table(results, time.time() - start)
+    return results
+
+
+# Call func(file), recording how long it took and whether it failed
+def run_granule(func, file):
+    start = time.time()
+    try:
+        counts = func(file)
+        return dict(granule=file, status="ok", seconds=time.time() - start, error="", **counts)
+    except Exception as e:
+        return dict(granule=file, status="failed", seconds=time.time() - start, error=str(e))
+
+
+def print_table(results, elapsed):
+    columns = ["pixels", "classified", "forest"]
+    width = max([len("granule")] + [len(result['granule']) for result in results])
+    print(f"{'granule':<{width}}  {'status':<6}  {'seconds':>8}  " + "  ".join(f"{c:>12}" for c in columns))
+    for result in sorted(results, key=lambda result: result['granule']):
+        counts = "  ".join(f"{result.get(c, ''):>12}" for c in columns)
+        print(f"{result['granule']:<{width}}  {result['status']:<6}  {result['seconds']:>8.1f}  {counts}")
+    for result in results:
+        if result['status'] == "failed":
+            print(f"failed {result['granule']}: {result['error']}")
+
+    pixels = sum(result.get('pixels', 0) for result in results)
+    failed = sum(result['status'] == "failed" for result in results)
+    rate = pixels / elapsed / 1e6 if elapsed else 0
+    print(f"Processed {len(results) - failed}/{len(results)} granules ({failed} failed) in {elapsed:.1f} s: "
+          f"{rate:.1f} Mpixels/s.")
@@ -0,0 +1,119 @@
+import argparse
+import pickle
+import sys
+
+import numpy as np
+
+from gnb_kernel import fast_model
+
+
+""" Classifier for two-band (VV/VH gamma0) inputs that looks up the class of
+    each pixel in a precomputed 2-D table instead of running the model.
+
+    Both bands are quantized onto size cells between db_min and db_max dB
+    (pixels outside the range fall into the first/last cell), and the table
+    holds the model's class at the center of every cell, computed once. With
+    the default 4096 cells over -50..10 dB a cell is ~0.015 dB wide, far below
+    the speckle of the filtered bands, so the table works the same way for any
+    model (Naive Bayes, trees, forests). Use accuracy_report to measure how
+    often it disagrees with the model. """
+class LUTClassifier:
+    def __init__(self, model, size=4096, db_min=-50.0, db_max=10.0, chunk_rows=256):
+        self.size = size
+        self.db_min = db_min
+        self.step = (db_max - db_min) / size
+
+        # cell centers in linear units, the same for both bands
+        centers = np.power(10, (db_min + (np.arange(size) + 0.5) * self.step) / 10).astype(np.float32)
+        classes = np.asarray(model.classes_)
+        dtype = np.uint8 if classes.min() >= 0 and classes.max() <= 255 else np.int16
+        predictor = fast_model(model)
+
+        # table[i, j] is the class of (VV cell i, VH cell j). predict a few rows
+        # of cells at a time to bound memory
+        self.table = np.empty((size, size), dtype=dtype)
+        vh = np.tile(centers, chunk_rows)
+        for row in range(0, size, chunk_rows):
+            nrows = min(chunk_rows, size - row)
+            X = np.column_stack([np.repeat(centers[row:row + nrows], size), vh[:nrows * size]])
+            self.table[row:row + nrows] = predictor.predict(X).reshape(nrows, size)
+
+    """ Table and grid of the classifier as arrays (see shared_model). """
+    def to_arrays(self):
+        return {'table': self.table, 'grid': np.array([self.size, self.db_min, self.step])}
+
+    """ Classifier using the given arrays (from to_arrays) without copying the table. """
+    @classmethod
+    def from_arrays(cls, arrays):
+        lut = cls.__new__(cls)
+        lut.table = arrays['table']
+        size, lut.db_min, lut.step = arrays['grid']
+        lut.size = int(size)
+        return lut
+
+    """ Cell index of each value of a band (linear units). """
+    def quantize(self, x):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            q = np.log10(x, dtype=np.float32)
+        q *= 10 / self.step
+        q -= self.db_min / self.step
+        np.clip(q, 0, self.size - 1, out=q)     # also maps log10(0) = -inf to 0
+        np.nan_to_num(q, copy=False, nan=0)
+        return q.astype(np.intp)
+
+    """ Class of each row of X (n_samples x 2, linear VV and VH), like model.predict(X). """
+    def predict(self, X):
+        X = np.asarray(X, dtype=np.float32)
+        index = self.quantize(X[:, 0])
+        index *= self.size
+        index += self.quantize(X[:, 1])
+        return self.table.ravel()[index]
+
+
+""" Compare a LUTClassifier with direct prediction of its model on X (or, if
+    X is None, n samples spread log-uniformly over the table's dB range).
+    Returns the fraction of samples where they disagree, overall and for each
+    class the model predicts. """
+def accuracy_report(lut, model, X=None, n=1_000_000, seed=0):
+    if X is None:
+        rng = np.random.default_rng(seed)
+        db = rng.uniform(lut.db_min, lut.db_min + lut.size * lut.step, size=(n, 2))
+        X = np.power(10, db / 10).astype(np.float32)
+
+    direct = fast_model(model).predict(X)
+    differ = lut.predict(X) != direct
+    report = {'samples': len(X), 'mismatch': float(np.mean(differ))}
+    for cls in np.unique(direct):
+        report[f"mismatch_class_{cls}"] = float(np.mean(differ[direct == cls]))
+    return report
+
+
+def print_report(report, size):
+    classes = ", ".join(f"{key[len('mismatch_class_'):]}: {value:.2e}"
+                        for key, value in report.items() if key.startswith("mismatch_class_"))
+    print(f"LUT {size}x{size}: {report['mismatch']:.2e} of {report['samples']} samples differ from the model "
+          f"(by class: {classes})")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Report how often a 2-D lookup table of a VV/VH classifier differs from the classifier.")
+    parser.add_argument("classifier", nargs="?", default="s1_classifier_nb_all_vv-vh.pkl",
+                        help="pickled classifier with two features, VV and VH (default: s1_classifier_nb_all_vv-vh.pkl)")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 4096],
+                        help="numbers of cells per band to compare (default: 1024 4096)")
+    parser.add_argument("--samples", type=int, default=1_000_000,
+                        help="number of random samples to compare (default: 1000000)")
+    args = parser.parse_args()
+
+    with open(args.classifier, 'rb') as clf:
+        model = pickle.load(clf)
+    if getattr(model, "n_features_in_", 2) != 2:
+        sys.exit(f"{args.classifier} doesn't have two features")
+
+    for size in args.sizes:
+        print_report(accuracy_report(LUTClassifier(model, size), model, n=args.samples), size)
+
+
+if __name__ == "__main__":
+    main()
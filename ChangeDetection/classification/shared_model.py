@@ -0,0 +1,52 @@
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from gnb_kernel import GaussianNBKernel
+from lut_classifier import LUTClassifier
+
+
+""" Share a classifier between worker processes without pickling it to every
+    worker: its parameter arrays (e.g. the 16 MB table of a LUTClassifier) are
+    copied once into a block of shared memory, and every worker builds the
+    classifier on views of that block. Supports the classifiers that can be
+    rebuilt from arrays (to_arrays/from_arrays). """
+MODEL_TYPES = {cls.__name__: cls for cls in (GaussianNBKernel, LUTClassifier)}
+
+
+""" Whether model can be shared with share_model. """
+def can_share(model):
+    return type(model).__name__ in MODEL_TYPES
+
+
+""" Copy the parameters of model into shared memory. Returns the shared memory
+    block, which the caller closes and unlinks once the workers are done, and
+    a small picklable description of the model to pass to attach_model. """
+def share_model(model):
+    arrays = model.to_arrays()
+    layout = {}
+    offset = 0
+    for name, arr in arrays.items():
+        offset = (offset + 63) // 64 * 64     # keep every array aligned
+        layout[name] = (offset, arr.shape, arr.dtype.str)
+        offset += arr.nbytes
+
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for name, arr in arrays.items():
+        start, shape, dtype = layout[name]
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)[...] = arr
+    return shm, (type(model).__name__, shm.name, layout)
+
+
+""" Rebuild a model shared with share_model in a worker. Returns the shared
+    memory block (keep a reference to it while the model is used) and the
+    model. """
+def attach_model(spec):
+    kind, name, layout = spec
+    shm = shared_memory.SharedMemory(name=name)
+    arrays = {}
+    for array_name, (start, shape, dtype) in layout.items():
+        arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)
+        arr.flags.writeable = False
+        arrays[array_name] = arr
+    return shm, MODEL_TYPES[kind].from_arrays(arrays)
@@ -7,6 +7,10 @@ from sklearn import tree
 import numpy as np
 import boto3
 import pickle
+import sys
+
+sys.path.insert(0, "../util/")
+from db_encoding import decode_db, file_encoding
 
 
 bucket = "processed-granules"
@@ -52,7 +56,13 @@ def get_data(file, bands):
 
     imgs = [tc]
     for i in range(2, len(bands) + 2):
-        imgs.append(combined.GetRasterBand(i).ReadAsArray().reshape(-1)[samples])
+        band = combined.GetRasterBand(i).ReadAsArray().reshape(-1)[samples]
+        # decode uint16 dB outputs back to linear gamma0. the vrt doesn't keep
+        # the encoding, so get it from the source file
+        encoding = file_encoding(vrt_files[i - 1])
+        if encoding:
+            band = decode_db(band, *encoding)
+        imgs.append(band)
     
     # drop all nan values
     data_labels = np.column_stack(imgs)
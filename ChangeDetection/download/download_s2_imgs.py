@@ -6,11 +6,14 @@ from pathlib import Path
 from sys import path_importer_cache
 
 import boto3
+import botocore
 from sentinelhub import SHConfig, WebFeatureService, DataCollection, Geometry, AwsTileRequest, AwsTile
 
 
 QUEUE = "S2ImgsToBeProcessed" # name of sqs queue to send messages to for processing
 REGION = "us-west-2" # aws region of queue
+# cloud masks, of which each tile has the one of its processing baseline (MSK_CLASSI_B00.jp2 from 04.00)
+cloud_mask_files = ['qi/MSK_CLOUDS_B00.gml', 'qi/MSK_CLASSI_B00.jp2']
 
 
 """ Authenticate the user based on the credentials in their config.json file.
@@ -108,11 +111,29 @@ def copy_to_s3(tile_list, dst_bucket, files, prefix="s2"):
             # construct the appropriate key, removing the /tiles/ prefix and stripping any folders from the
             # individual files (ex. R10m/B04.jp2 -> B04.jp2)
             dst_key = (f"{tile_prefix}_{os.path.basename(file)}")
-            s3.meta.client.copy(copy_source, dst_bucket, dst_key, ExtraArgs={'RequestPayer': 'requester'})
+            try:
+                s3.meta.client.copy(copy_source, dst_bucket, dst_key, ExtraArgs={'RequestPayer': 'requester'})
+            except botocore.exceptions.ClientError as e:
+                # a tile only has the cloud mask of its processing baseline
+                if file not in cloud_mask_files or e.response['Error']['Code'] not in ("404", "NoSuchKey"):
+                    raise e
         # send message to queue to start processing for this tile
         q.send_message(MessageBody = f"{dst_bucket}/{tile_prefix}")
 
 
+""" Given a list of tiles in the Sentinelhub S2 bucket, send their tile directories to the processing queue so
+    s2_lambda reads them in place (requester pays), without copying them to our bucket. """
+def queue_tiles(tile_list):
+    sqs = boto3.resource("sqs", region_name=REGION)
+    q = sqs.get_queue_by_name(QueueName=QUEUE)
+
+    for tile in tile_list:
+        # strip s3:// from the path (ex. sentinel-s2-l1c/tiles/18/N/WM/2021/10/10/0)
+        body = tile[1][5:]
+        print(f"Queueing {body}")
+        q.send_message(MessageBody = body)
+
+
 """ Given a string, return that string padded with zeroes, if necessary.
     Useful for ensuring months/days all have the same length (3 -> 03). """
 def pad_zeroes(string):
@@ -171,7 +192,13 @@ def main():
     parser.add_argument("-collection", "--c", dest="collection", choices=["L2A", "L1C"],
                         help="collection of s2 images to choose from (top of atmosphere/surface reflectance")
     parser.add_argument("-dst", metavar="bucket", type=str,
-                        help="s3 bucket to store downloaded scenes in")
+                        help="s3 bucket to store downloaded scenes in (with -archive)")
+    parser.add_argument("-archive", action="store_true",
+                        help="copy the scenes to -dst before processing them, instead of processing them in "
+                             "place from the Sentinel-2 bucket")
+    parser.add_argument("-bands", nargs="+", default=["B04", "B08"],
+                        help="bands to copy with -archive, e.g. B02 B04 B08 B11 for the indices of s2_batch.py --indices "
+                             "(default: B04 B08)")
     args = parser.parse_args()
 
 
@@ -181,14 +208,24 @@ def main():
 
     print("Fetching scenes...")
     tile_list = search(config, date_range=args.date_range, boundary=args.boundary, collection=args.collection)
-    # grab only desired files: R band, NIR band, metadata file, and cloud mask
+    # grab only desired files: R band, NIR band, metadata file, and cloud mask (MSK_CLOUDS_B00.gml before
+    # processing baseline 04.00, MSK_CLASSI_B00.jp2 since; each tile has one of them)
     # files = ['R10m/B04.jp2', 'R10m/B08.jp2', 'tileInfo.json', 'qi/MSK_CLOUDS_B00.gml']
-    files = ['B04.jp2', 'B08.jp2', 'tileInfo.json', 'qi/MSK_CLOUDS_B00.gml']
+    files = [f"{band}.jp2" for band in args.bands] + ['tileInfo.json'] + cloud_mask_files
 
     if len(tile_list) == 0:
         print("No tiles matching the criteria were found.")
         return
     
+    if not args.archive:
+        # s2_lambda reads only the part of each band it needs straight from
+        # the Sentinel-2 bucket, so nothing needs to be copied
+        process = input(f"Process {len(tile_list)} scene(s) in place? (Y/N) ")
+        if process.lower() in {'y', 'yes'}:
+            queue_tiles(tile_list)
+            print("Done.")
+        return
+
     download = input(f"Copy {len(tile_list)} scene(s) to s3://{args.dst}? (Y/N) ")
     if download.lower() not in {'y', 'yes'}:
         return
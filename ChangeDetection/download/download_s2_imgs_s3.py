@@ -4,6 +4,9 @@ import os
 import datetime
 from dateutil.parser import parse as parse_date
 
+QUEUE = "S2ImgsToBeProcessed" # name of sqs queue to send messages to for processing
+REGION = "us-west-2" # aws region of queue
+
 '''
 full example CLI command: aws s3 ls s3://sentinel-s2-l2a/tiles/18/N/WM/2021/10/10/0/R10m/B04.jp2 --request-payer requester --region eu-central-1
 
@@ -60,8 +63,31 @@ def download(destination_bucket: str, start_date: datetime.datetime, end_date: d
                 else:
                     print(f"No {file} found within {tile} for {temp_date.date()}")
         temp_date += datetime.timedelta(days=1)
+
+
+def queue(start_date: datetime.datetime, end_date: datetime.datetime, tiles: list):
+    '''
+    Sends the tile directory of each of the provided tiles that has an image for each of the dates in between and
+        including the start and end date to the processing queue, so s2_lambda reads them in place instead of
+        from a copy. Assumes request payer.
+    '''
+    target_bucket ='sentinel-s2-l2a'
+    
+    s3_client = boto3.client("s3")
+    q = boto3.resource("sqs", region_name=REGION).get_queue_by_name(QueueName=QUEUE)
+    temp_date = start_date
+    while temp_date.date() <= end_date.date():
+        date_str = f"{temp_date.year}/{temp_date.month}/{temp_date.day}/0"
+        for tile in tiles:
+            target_prefix = f'tiles/{tile}{date_str}'
+            if checkExistence(s3_client, target_bucket, f"{target_prefix}/R10m/B04.jp2"):
+                q.send_message(MessageBody=f"{target_bucket}/{target_prefix}")
+            else:
+                print(f"No image found within {tile} for {temp_date.date()}")
+        temp_date += datetime.timedelta(days=1)
         
 
+
 def main():
     parser = argparse.ArgumentParser(
         description="Search for and download L8 scenes that match criteria.")
@@ -71,6 +97,8 @@ def main():
                         help="filter scenes by acquisition date (format: yyyy-mm-dd yyyy-mm-dd)")
     parser.add_argument("-dst", metavar="bucket", type=str,
                         help="s3 bucket to store downloaded scenes in")
+    parser.add_argument("-queue", action="store_true",
+                        help="instead of copying the scenes, send them to the processing queue to be read in place")
     args = parser.parse_args()
     
     start_date = parse_date(args.date_range[0])
@@ -79,10 +107,14 @@ def main():
     left = '18/N/WM/'   # see note at top of file
     right = '18/N/XM/'
     tiles = [left, right]
-    # grab only desired files: R band, NIR band, metadata file, and cloud mask   
-    files = ['R10m/B04.jp2', 'R10m/B08.jp2', 'tileInfo.json', 'qi/MSK_CLOUDS_B00.gml']
+    # grab only desired files: R band, NIR band, metadata file, and cloud mask (MSK_CLOUDS_B00.gml before
+    # processing baseline 04.00, MSK_CLASSI_B00.jp2 since; each tile has one of them)
+    files = ['R10m/B04.jp2', 'R10m/B08.jp2', 'tileInfo.json', 'qi/MSK_CLOUDS_B00.gml', 'qi/MSK_CLASSI_B00.jp2']
     
-    download(args.dst, start_date, end_date, tiles, files)
+    if args.queue:
+        queue(start_date, end_date, tiles)
+    else:
+        download(args.dst, start_date, end_date, tiles, files)
     
     print("Done.")
 
@@ -0,0 +1,134 @@
+import ast
+
+from osgeo import gdal
+import numpy as np
+
+from arr_to_gtiff import arr_to_gtiff, arrs_to_gtiff
+from s3_output import output_path
+
+
+# Spectral indices as expressions over named surface reflectance bands
+# (blue, green, red, nir, swir1, swir2)
+INDICES = {
+    'ndvi': "(nir - red) / (nir + red)",
+    'ndmi': "(nir - swir1) / (nir + swir1)",
+    'ndwi': "(green - nir) / (green + nir)",
+    'evi': "2.5 * (nir - red) / (nir + 6 * red - 7.5 * blue + 1)",
+    'savi': "1.5 * (nir - red) / (nir + red + 0.5)",
+}
+
+
+""" Names of the bands an index expression uses. """
+def bands_of(expression):
+    return {node.id for node in ast.walk(ast.parse(expression, mode='eval')) if isinstance(node, ast.Name)}
+
+
+""" Names of the bands a set of index expressions uses (each is read once). """
+def used_bands(indices):
+    return set().union(*(bands_of(expression) for expression in indices.values()))
+
+
+""" Open a band of a raster so its pixels line up with a reference dataset,
+    resampling it (nearest neighbour, in a VRT) if its resolution differs,
+    e.g. the 20 m Sentinel-2 SWIR bands on the 10 m grid. Raises RuntimeError
+    if the file can't be opened. """
+def open_aligned(file, ref_ds):
+    ds = gdal.Open(file)
+    if ds is None:
+        raise RuntimeError(f"Can't open {file}: {gdal.GetLastErrorMsg()}")
+    if (ds.RasterXSize, ds.RasterYSize) != (ref_ds.RasterXSize, ref_ds.RasterYSize):
+        ds = gdal.Translate("", ds, format="VRT", width=ref_ds.RasterXSize, height=ref_ds.RasterYSize)
+    return ds
+
+
+""" Evaluate several index expressions over the same bands, reading every band
+    only once. bands maps band names to (dataset, scale, offset), where
+    scale/offset convert the stored values to reflectance. indices maps output
+    names to expressions (e.g. INDICES). The bands are read and the indices
+    evaluated block_rows rows at a time, so adding indices doesn't add any
+    reads, only one float32 output each.
+
+    window (xoff, yoff, xsize, ysize) and mask work like in
+    processing_utils.mask_clouds_and_calc_ndvi_bands: mask is either an array
+    the size of the output or a function mask(xoff, yoff, xsize, ysize). Masked
+    pixels, pixels where any band is fill (the stored value of missing data, 0
+    for both Landsat and Sentinel-2) and invalid results (e.g. 0/0) are NaN in
+    every output. Returns a dict of output name -> float32 array. """
+def calc_indices(bands, indices, mask=None, window=None, block_rows=1024, fill=0):
+    used = used_bands(indices)
+    missing = used - set(bands)
+    if missing:
+        raise ValueError(f"bands not available: {', '.join(sorted(missing))}")
+
+    ref_ds = bands[next(iter(used))][0]
+    xoff, yoff, xsize, ysize = window or (0, 0, ref_ds.RasterXSize, ref_ds.RasterYSize)
+    code = {name: compile(expression, name, 'eval') for name, expression in indices.items()}
+    outputs = {name: np.empty((ysize, xsize), dtype=np.float32) for name in indices}
+
+    for row in range(0, ysize, block_rows):
+        nrows = min(block_rows, ysize - row)
+
+        if callable(mask):
+            invalid = mask(xoff, yoff + row, xsize, nrows) != 0
+        elif mask is not None:
+            invalid = mask[row:row + nrows] != 0
+        else:
+            invalid = np.zeros((nrows, xsize), dtype=bool)
+
+        # read every band once, as float32 reflectance
+        block = {}
+        for name in used:
+            ds, scale, offset = bands[name]
+            stored = ds.GetRasterBand(1).ReadAsArray(xoff, yoff + row, xsize, nrows)
+            if fill is not None:
+                invalid |= stored == fill
+            arr = stored.astype(np.float32)
+            arr *= scale
+            arr += offset
+            block[name] = arr
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for name, expression in code.items():
+                out = outputs[name][row:row + nrows]
+                out[...] = eval(expression, {'__builtins__': {}}, block)
+                out[invalid | ~np.isfinite(out)] = np.nan
+
+    return outputs
+
+
+""" Look up index expressions by name, e.g. ['ndvi', 'ndmi'] -> {'ndvi': ..., 'ndmi': ...}. """
+def index_expressions(names):
+    unknown = [name for name in names if name not in INDICES]
+    if unknown:
+        raise ValueError(f"unknown indices: {', '.join(unknown)} (expected some of {', '.join(INDICES)})")
+    return {name: INDICES[name] for name in names}
+
+
+""" Name of the output of calc_indices: INDICES_MASKED for all indices in one
+    geotiff, or IDX_{INDEX} for a single index. This keeps e.g. IDX_NDVI (from
+    reflectance) apart from the NDVI_MASKED outputs of the lambdas' NDVI path
+    (from stored values), whose values differ, also for searches by substring
+    like make_csv's. """
+def index_product(name=None):
+    return f"IDX_{name.upper()}" if name else "INDICES_MASKED"
+
+
+""" Save the outputs of calc_indices as the bands of a single geotiff
+    ({prefix}_INDICES_MASKED.TIF), or as one geotiff per index
+    ({prefix}_IDX_{INDEX}.TIF) if separate, see index_product. base_tif,
+    gt and the output size set the georeferencing like in arr_to_gtiff.
+    Returns the files. """
+def write_indices(outputs, prefix, base_tif, gt, separate=False):
+    names = list(outputs)
+    ysize, xsize = outputs[names[0]].shape
+    if separate:
+        files = []
+        for name in names:
+            file = output_path(f"{prefix}_{index_product(name)}.TIF", outputs[name].nbytes)
+            arr_to_gtiff(outputs[name], file, base_tif, xsize=xsize, ysize=ysize, gt=gt)
+            files.append(file)
+        return files
+
+    file = output_path(f"{prefix}_{index_product()}.TIF", sum(outputs[name].nbytes for name in names))
+    arrs_to_gtiff([outputs[name] for name in names], file, base_tif, names=names, xsize=xsize, ysize=ysize, gt=gt)
+    return [file]
@@ -0,0 +1,182 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import os
+import sys
+import time
+
+import boto3
+
+# allow imports from sibling directories
+sys.path.insert(0, "../util/")
+from ledger import list_objects
+from granule_cache import GranuleCache
+from aoi import load_aoi
+from band_math import INDICES, index_product
+
+
+# Shared driver for the optical (Landsat-8/Sentinel-2) batch scripts: finds the
+# granules that still need processing from one paginated listing each of the
+# source and destination prefixes, then processes them in a thread or process
+# pool and reports throughput.
+
+# set up by init_worker in each worker process (or once, for threads)
+s3 = None
+cache = None    # optional GranuleCache for raw granules
+aoi = None      # optional area of interest
+indices = None  # optional list of indices to calculate instead of NDVI
+separate = False
+
+
+# Add the options of the driver to a batch script's argument parser. name is
+# what the script calls its granules (e.g. scenes)
+def add_arguments(parser, name="granules"):
+    parser.add_argument("--cache-dir", type=str, default=None,
+                        help=f"keep local copies of raw {name} in this directory (default: no cache)")
+    parser.add_argument("--cache-size", type=float, default=50,
+                        help=f"maximum size of the raw {name} cache in GB (default: 50)")
+    parser.add_argument("--ledger", type=str, default=None,
+                        help=f"sqlite file to record processed {name} in, so re-runs only process new or "
+                             f"changed {name} (default: check for existing outputs in s3)")
+    parser.add_argument("--aoi", type=str, default=None,
+                        help="only process the part of each scene that covers this area of interest, "
+                             "e.g. ../polygons/aoi_1.geojson (default: whole scenes)")
+    parser.add_argument("--indices", nargs="+", choices=list(INDICES), default=None,
+                        help="calculate these indices (from reflectance, reading each band once) instead of "
+                             "NDVI, e.g. ndvi ndmi evi (default: NDVI only)")
+    parser.add_argument("--separate", action="store_true",
+                        help="with --indices, write one file per index instead of one multi-band file")
+    parser.add_argument("--workers", type=int, default=4,
+                        help=f"number of {name} to process in parallel (default: 4)")
+    parser.add_argument("--pool", choices=["thread", "process"], default="thread",
+                        help="run the workers as threads (GDAL releases the GIL while reading) or as "
+                             "processes (default: thread)")
+
+
+# Processing parameters to record in the ledger: params (those of NDVI) with
+# the --indices, --separate and --aoi options
+def run_params(params, args):
+    if args.indices:
+        params = dict(params, index=args.indices, separate=args.separate)
+    if args.aoi:
+        params = dict(params, aoi=os.path.basename(args.aoi))
+    return params
+
+
+# Name of the (first) output of a granule, see band_math.write_indices
+def product_of(indices=None, separate=False):
+    if not indices:
+        return 'NDVI_MASKED'
+    return index_product(indices[0] if separate else None)
+
+
+# Arguments of init_worker for the parsed options
+def init_args(args):
+    return (args.cache_dir, int(args.cache_size * 1024**3), args.aoi, args.indices, args.separate)
+
+
+# Set up the state the batch scripts' process functions use: an s3 client,
+# the raw granule cache, the area of interest and the indices to calculate
+def init_worker(cache_dir=None, cache_bytes=None, aoi_file=None, index_names=None, separate_indices=False):
+    global s3, cache, aoi, indices, separate
+    s3 = boto3.client('s3')
+    indices = index_names
+    separate = separate_indices
+    if cache_dir:
+        cache = GranuleCache(cache_dir, cache_bytes, s3)
+    if aoi_file:
+        aoi = load_aoi(aoi_file)
+
+
+# Find the granules to process, as a dict of granule -> etag.
+# granule_of maps a source key to its granule (or None to skip the key), so
+# granules made of several files (e.g. Sentinel-2 bands) are listed once, with
+# the etags of their files combined. With a ledger, granules that are new,
+# changed, or were processed with different parameters are returned.
+# Otherwise output_of maps a granule to its output key, and granules whose
+# output isn't in the destination listing are returned.
+def find_pending(s3, src_bucket, src_prefix, granule_of, dst_bucket, dst_prefix, output_of,
+                 ledger=None, product=None, params=None):
+    etags = {}
+    for key, etag in list_objects(s3, src_bucket, src_prefix):
+        granule = granule_of(key)
+        if granule:
+            etags.setdefault(granule, []).append(etag)
+    granules = {granule: ','.join(sorted(granule_etags)) for granule, granule_etags in etags.items()}
+
+    if ledger:
+        return {granule: etag for granule, etag in granules.items()
+                if ledger.pending(granule, etag, {product: params})}
+
+    outputs = {key for key, _ in list_objects(s3, dst_bucket, dst_prefix)}
+    return {granule: etag for granule, etag in granules.items() if output_of(granule) not in outputs}
+
+
+# Run process_func(granule, etag) for every granule on workers threads or
+# processes. process_func returns the output it wrote (or None if there was
+# nothing to write). initializer(*initargs) sets up the state process_func
+# needs; it runs once here for threads, and in every worker process for
+# processes. Progress is recorded in the ledger (from this thread only, since
+# sqlite connections can't be shared). Prints the hits and misses of the raw
+# granule cache at the end, counted in each worker process for processes.
+# Returns a list of (granule, status, seconds, error) tuples.
+def run_batch(granules, process_func, workers=4, pool="thread", initializer=None, initargs=(),
+              ledger=None, product=None, params=None):
+    if pool == "process":
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+    else:
+        if initializer:
+            initializer(*initargs)
+        executor = ThreadPoolExecutor(max_workers=workers)
+
+    start = time.time()
+    results = []
+    cache_stats = {'hits': 0, 'misses': 0}
+    with executor:
+        futures = {}
+        for granule, etag in granules.items():
+            if ledger:
+                ledger.start(granule, etag, product, params)
+            futures[executor.submit(timed, process_func, granule, etag)] = granule
+
+        for future in as_completed(futures):
+            granule = futures[future]
+            try:
+                output, seconds, stats = future.result()
+                for stat, count in stats.items():
+                    cache_stats[stat] += count
+                status, error = ("ok" if output else "skipped"), ""
+                if ledger:
+                    ledger.finish(granule, product, output)
+            except Exception as e:
+                status, seconds, error = "failed", 0.0, str(e)
+                if ledger:
+                    ledger.fail(granule, product, e)
+            results.append((granule, status, seconds, error))
+            print(f"[{len(results)}/{len(futures)}] {status} {granule} {error}")
+
+    print_report(results, time.time() - start)
+    if pool != "process":
+        # threads share this process's cache, so its counts are the totals
+        cache_stats = cache.stats() if cache else None
+    if cache_stats and any(cache_stats.values()):
+        print(f"Cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+    return results
+
+
+# Call func and also return how long it took, and the cache hits and misses
+# during the call (only exact in worker processes, which make one call at a time)
+def timed(func, *args):
+    start = time.time()
+    before = cache.stats() if cache else {}
+    output = func(*args)
+    after = cache.stats() if cache else {}
+    return output, time.time() - start, {stat: after[stat] - before[stat] for stat in after}
+
+
+def print_report(results, elapsed):
+    failed = [result for result in results if result[1] == "failed"]
+    for granule, _, _, error in failed:
+        print(f"failed {granule}: {error}")
+    busy = sum(result[2] for result in results)
+    rate = len(results) / elapsed * 60 if elapsed else 0
+    print(f"Processed {len(results) - len(failed)}/{len(results)} granules ({len(failed)} failed) "
+          f"in {elapsed:.1f} s: {rate:.1f} granules/min, {busy / max(len(results), 1):.1f} s per granule.")
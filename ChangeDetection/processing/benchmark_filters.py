@@ -0,0 +1,166 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import cv2 as cv
+
+from s1_batch import enhanced_lee, enhanced_lee_f32, enhanced_lee_sat, moving_std
+from window_stats import WindowStats
+
+
+# Benchmark the S1 speckle filters on synthetic rasters. Every case (filter,
+# size, nodata fraction) runs in its own process so its peak memory can be
+# measured, and the results are written to a JSON file. Runs fully offline.
+#
+#   python benchmark_filters.py                  # 1k^2 to 16k^2
+#   python benchmark_filters.py --quick          # small pre-merge check
+
+
+# Filter implementations, called as filter(img, win_size, num_looks)
+FILTERS = {
+    'enhanced_lee': lambda img, win_size, num_looks: enhanced_lee(img, win_size, num_looks, nodata=np.nan),
+    'enhanced_lee_f32': lambda img, win_size, num_looks: enhanced_lee_f32(img, win_size, num_looks, nodata=np.nan),
+    'enhanced_lee_sat': lambda img, win_size, num_looks: enhanced_lee_sat(img, win_size, num_looks, nodata=np.nan),
+    'moving_std': lambda img, win_size, num_looks: moving_std(img, win_size, nodata=np.nan),
+    'moving_std_sat': lambda img, win_size, num_looks: moving_std(
+        img, win_size, nodata=np.nan, stats=WindowStats(img, np.nan, pad=win_size // 2)),
+}
+
+SIZES = [1024, 2048, 4096, 8192, 16384]
+NAN_FRACTIONS = [0.0, 0.1, 0.5]
+QUICK_SIZES = [256, 512]
+QUICK_NAN_FRACTIONS = [0.0, 0.1]
+
+
+# Synthetic gamma0 image: a piecewise constant backscatter (64x64 patches)
+# multiplied by fully developed speckle, i.e. gamma distributed with mean 1 and
+# num_looks looks. The first nan_fraction of the columns are nodata, like the
+# edge of a granule's swath.
+def synthetic_speckle(size, nan_fraction=0.0, num_looks=3, seed=0):
+    rng = np.random.default_rng(seed)
+    patches = rng.gamma(2.0, 0.05, size=(size // 64 + 1, size // 64 + 1)).astype(np.float32)
+    img = np.repeat(np.repeat(patches, 64, axis=0), 64, axis=1)[:size, :size]
+    img *= rng.gamma(num_looks, 1 / num_looks, size=(size, size)).astype(np.float32)
+    img[:, :int(round(nan_fraction * size))] = np.nan
+    return img
+
+
+# Peak resident set size of this process in MB
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+# Run a single case in this process and return its results
+def run_case(case):
+    img = synthetic_speckle(case['size'], case['nan_fraction'], case['num_looks'], case['seed'])
+    filter_func = FILTERS[case['filter']]
+    baseline = peak_rss_mb()
+
+    times = []
+    for _ in range(case['repeat']):
+        start = time.perf_counter()
+        filter_func(img, case['win_size'], case['num_looks'])
+        times.append(time.perf_counter() - start)
+
+    pixels = case['size'] ** 2
+    return dict(case,
+                status='ok',
+                times_s=times,
+                best_s=min(times),
+                median_s=float(np.median(times)),
+                mpixels_per_s=pixels / min(times) / 1e6,
+                baseline_rss_mb=baseline,
+                peak_rss_mb=peak_rss_mb())
+
+
+# Run a case in a new process, so peak memory isn't shared between cases
+def run_case_subprocess(case, timeout=None):
+    cmd = [sys.executable, os.path.abspath(__file__), '--case', json.dumps(case)]
+    try:
+        proc = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return dict(case, status='timeout')
+    if proc.returncode != 0:
+        # e.g. MemoryError, or killed by the OOM killer on large sizes
+        error = proc.stderr.strip().splitlines()[-1:] or [f"exit code {proc.returncode}"]
+        return dict(case, status='error', error=error[0])
+    return json.loads(proc.stdout.splitlines()[-1])
+
+
+def print_result(result):
+    name = f"{result['filter']:<18} {result['size']:>6}^2 nan={result['nan_fraction']:<4}"
+    if result['status'] != 'ok':
+        print(f"{name} {result['status']}: {result.get('error', '')}")
+    else:
+        print(f"{name} {result['best_s']:9.3f} s {result['mpixels_per_s']:8.2f} Mpx/s "
+              f"peak {result['peak_rss_mb']:8.1f} MB (input {result['baseline_rss_mb']:.1f} MB)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the S1 speckle filters on synthetic rasters.")
+    parser.add_argument("--quick", action="store_true",
+                        help="run small sizes only, once each (pre-merge check)")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        help=f"image sizes (width = height) to run (default: {SIZES})")
+    parser.add_argument("--nan-fractions", type=float, nargs="+",
+                        help=f"fractions of nodata pixels to run (default: {NAN_FRACTIONS})")
+    parser.add_argument("--filters", nargs="+", choices=list(FILTERS), default=list(FILTERS),
+                        help="filter implementations to run (default: all)")
+    parser.add_argument("--win-size", type=int, default=5, help="filter window size")
+    parser.add_argument("--num-looks", type=int, default=3, help="number of looks of the speckle")
+    parser.add_argument("--repeat", type=int, help="timed runs per case (default: 3, 1 with --quick)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the synthetic images")
+    parser.add_argument("--timeout", type=float, help="give up on a case after this many seconds")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON results file")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return
+
+    sizes = args.sizes or (QUICK_SIZES if args.quick else SIZES)
+    nan_fractions = args.nan_fractions or (QUICK_NAN_FRACTIONS if args.quick else NAN_FRACTIONS)
+    repeat = args.repeat or (1 if args.quick else 3)
+
+    results = []
+    for size in sizes:
+        for nan_fraction in nan_fractions:
+            for filter_name in args.filters:
+                case = {'filter': filter_name, 'size': size, 'nan_fraction': nan_fraction,
+                        'win_size': args.win_size, 'num_looks': args.num_looks,
+                        'repeat': repeat, 'seed': args.seed}
+                result = run_case_subprocess(case, args.timeout)
+                print_result(result)
+                results.append(result)
+
+    report = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv.__version__,
+        'results': results,
+    }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Wrote {len(results)} results to {args.output}")
+
+    # non-zero exit status if any case failed, so --quick can gate merges
+    if any(result['status'] != 'ok' for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
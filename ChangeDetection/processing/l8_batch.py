@@ -1,48 +1,102 @@
+import argparse
 import os
 import sys
 
 import boto3
-import botocore
 
 # allow imports from sibling directories
 sys.path.insert(0, "../util/")
-from l8_lambda import calc_ndvi_and_mask_l8_clouds
+from l8_lambda import calc_ndvi_and_mask_l8_clouds, calc_indices_l8, cloud_flags
+from ledger import Ledger
+from s3_output import upload_output
+from tar_index import get_tar_index
+import batch_driver
+
+# processing parameters recorded in the ledger for each scene
+ndvi_params = {'index': 'ndvi', 'cloud_mask': cloud_flags}
+
+src_bucket = "raw-granules"
+dest_bucket = "processed-granules"
+
+# name of the (first) output of each scene (see batch_driver.product_of), set by main
+product = None
+
+
+# granule (bucket/key) of a source key, or None for files that aren't scenes
+def granule_of(key):
+    if not key.endswith(".tar"):
+        return None     # e.g. tar index files
+    return f"{src_bucket}/{key}"
+
+
+# output key of a scene
+def output_of(granule):
+    key = granule.split('/', 1)[1]
+    return f"{os.path.splitext(key)[0]}_{product}.TIF"
+
+
+# Calculate NDVI (or the indices) for a scene and upload it, using the state
+# set up by batch_driver.init_worker. Returns the (first) output, or None if
+# the scene doesn't intersect the aoi
+def process_scene(granule, etag):
+    s3 = batch_driver.s3
+    bucket, key = granule.split('/', 1)
+    if batch_driver.cache:
+        # read the scene from a local copy instead
+        with batch_driver.cache.local_copy(bucket, key, etag) as local:
+            results = calc_scene(f"/vsitar/{local}")
+    else:
+        # vsis3 tells gdal that the file is in an s3 bucket. read the bands
+        # as byte ranges of the tar using its member index
+        index = get_tar_index(s3, bucket, key, etag)
+        results = calc_scene(f"/vsis3/{bucket}/{key}", index)
+    if not results:
+        return None
+
+    prefix = os.path.dirname(key)
+    outputs = []
+    for result in results:
+        print(f"Generated {result}")
+        key = f"{prefix}/{os.path.basename(result)}"
+        upload_output(result, dest_bucket, key, s3)
+        print(f"Uploaded {key} to {dest_bucket}")
+        outputs.append(f"{dest_bucket}/{key}")
+    return outputs[0]
+
+
+# Calculate NDVI or the indices for a scene, returns the files (or None)
+def calc_scene(file, index=None):
+    if batch_driver.indices:
+        return calc_indices_l8(file, batch_driver.indices, batch_driver.aoi, index, batch_driver.separate)
+    result = calc_ndvi_and_mask_l8_clouds(file, batch_driver.aoi, index)
+    return [result] if result else None
 
 
 def main():
-    src_bucket = "raw-granules"
-    dest_bucket = "processed-granules"
-    s3 = boto3.client('s3')
-
-    response = s3.list_objects(Bucket=src_bucket, Prefix="landsat")
-    granules = []
-    for key in response['Contents']:
-            granule = f"{src_bucket}/{key['Key']}"
-            try:
-                # check if file already exists
-                s3.head_object(Bucket=dest_bucket, Key=f"{os.path.splitext(key['Key'])[0]}_NDVI_MASKED.TIF")
-            except botocore.exceptions.ClientError as e:
-                if e.response['Error']['Code'] == "404":
-                    granules.append(granule)
-                else:
-                    raise e
-
-    granules = set(granules)
-    for granule in granules:
-        prefix = granule.split('/', 1)
-        bucket = prefix[0]
-        key = prefix[1]
-        # vsis3 tells gdal that the file is in an s3 bucket
-        result = calc_ndvi_and_mask_l8_clouds(f"/vsitar/vsis3/{bucket}/{key}")
-        if result:
-            print(f"Generated {result}")
-            prefix = os.path.dirname(key)
-            key = f"{prefix}/{result}"
-            s3.upload_file(result, dest_bucket, key)
-            print(f"Uploaded {key} to {dest_bucket}")
-            os.remove(result)
-    
-    print(f"Processed {len(granules)} granules.")
+    global product
+    parser = argparse.ArgumentParser(
+        description="Calculate NDVI (or other indices, from surface reflectance) and mask clouds for "
+                    "unprocessed Landsat-8 scenes.")
+    batch_driver.add_arguments(parser, "scenes")
+    args = parser.parse_args()
+    params = batch_driver.run_params(ndvi_params, args)
+
+    # output_of runs here, in the main thread
+    product = batch_driver.product_of(args.indices, args.separate)
+
+    ledger = None
+    if args.ledger:
+        # only process scenes that are new, changed, or were processed with different parameters
+        ledger = Ledger(args.ledger)
+
+    granules = batch_driver.find_pending(boto3.client('s3'), src_bucket, "landsat", granule_of,
+                                         dest_bucket, "landsat", output_of,
+                                         ledger=ledger, product=product, params=params)
+    print(f"Found {len(granules)} scenes to process.")
+
+    batch_driver.run_batch(granules, process_scene, args.workers, args.pool,
+                           initializer=batch_driver.init_worker, initargs=batch_driver.init_args(args),
+                           ledger=ledger, product=product, params=params)
 
 
 if __name__ == "__main__":
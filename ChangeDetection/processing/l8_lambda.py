@@ -3,67 +3,151 @@ import os
 import sys
 
 from osgeo import gdal
-import numpy as np
 import boto3
 
 # sys.path.insert(0, "../util/") # only needed if running locally
-from processing_utils import mask_clouds_and_calc_ndvi
+from processing_utils import mask_clouds_and_calc_ndvi_bands
 from arr_to_gtiff import arr_to_gtiff
+from s3_output import output_path, upload_output
+from landsat_qa import decode_qa
+from aoi import load_aoi, aoi_window, window_geotransform
+from tar_index import get_tar_index, member_path
+from band_math import calc_indices, index_expressions, open_aligned, used_bands, write_indices
+
+# QA_PIXEL flags to mask out
+cloud_flags = ['cloud', 'cloud_shadow']
+
+# Collection 2 surface reflectance band of each band name used by the index
+# expressions (see band_math), and the scale/offset that convert it to reflectance
+sr_bands = {'blue': "SR_B2", 'green': "SR_B3", 'red': "SR_B4", 'nir': "SR_B5", 'swir1': "SR_B6", 'swir2': "SR_B7"}
+sr_scale = 0.0000275
+sr_offset = -0.2
 
 
 def lambda_handler(event, context):
     bucket = event['Records'][0]['s3']['bucket']['name']
     key = urllib.parse.unquote_plus(event['Records'][0]['s3']['object']['key'], encoding='utf-8')
+    etag = event['Records'][0]['s3']['object'].get('eTag')
+    
+    # ignore the tar index files stored next to the scenes
+    if not key.endswith(".tar"):
+        return
     
-    # we can only write files to the tmp directory (max. 512 mb)
+    # outputs are kept in memory, large ones fall back to the tmp directory,
+    # which is the only place we can write files (max. 512 mb)
     os.chdir("/tmp")
     
-    # vsitar tells gdal that the file is a tarfile
-    # vsis3 tells gdal that the file is in an s3 bucket
-    result = calc_ndvi_and_mask_l8_clouds(f"/vsitar/vsis3/{bucket}/{key}")
-    print(f"Generated {result}")
+    # optionally clip the output to an area of interest, e.g. /vsis3/bucket/aoi.geojson
+    aoi = load_aoi(os.environ["AOI"]) if os.environ.get("AOI") else None
+    
+    # vsis3 tells gdal that the file is in an s3 bucket. the tar index lets
+    # gdal read each band with a single byte range instead of going through
+    # the tar headers (vsitar)
+    s3 = boto3.client('s3')
+    index = get_tar_index(s3, bucket, key, etag)
+    if os.environ.get("INDICES"):
+        # several indices from one read of the bands, e.g. INDICES=ndvi,ndmi,evi
+        results = calc_indices_l8(f"/vsis3/{bucket}/{key}", os.environ["INDICES"].split(','), aoi, index,
+                                  separate=os.environ.get("SEPARATE_INDICES") == "1")
+    else:
+        result = calc_ndvi_and_mask_l8_clouds(f"/vsis3/{bucket}/{key}", aoi, index)
+        results = [result] if result else None
+    if not results:
+        return
     
-    # upload generated file to s3
+    # upload generated files to s3
     dest_bucket = "processed-granules"
     prefix = os.path.dirname(key)
-    key = f"{prefix}/{result}"
-    s3 = boto3.client('s3')
-    s3.upload_file(result, dest_bucket, key)
-    print(f"Uploaded {key} to {dest_bucket}")
-    os.remove(result)
+    for result in results:
+        print(f"Generated {result}")
+        key = f"{prefix}/{os.path.basename(result)}"
+        upload_output(result, dest_bucket, key, s3)
+        print(f"Uploaded {key} to {dest_bucket}")
     
     
-""" Given a the base name of a Landsat 8 scene, caclulate NDVI, mask clouds, and save the result as a geotiff. """
-def calc_ndvi_and_mask_l8_clouds(file):
+""" Given a the base name of a Landsat 8 scene, caclulate NDVI, mask clouds, and save the result as a geotiff.
+    If an aoi (see load_aoi) is given, only the part of the scene that covers it is read and saved. Returns
+    None if the scene doesn't intersect the aoi. file is either a /vsitar path, or the path of the tar itself
+    along with its member index (see tar_index). """
+def calc_ndvi_and_mask_l8_clouds(file, aoi=None, index=None):
     red_band = "SR_B4"
     nir_band = "SR_B5"
     qa_band = "QA_PIXEL"
     
     base_name = os.path.splitext(os.path.basename(file))[0]
-    red_band_file = f"{file}/{base_name}_{red_band}.TIF"
-    nir_band_file = f"{file}/{base_name}_{nir_band}.TIF"
-    qa_band_file = f"{file}/{base_name}_{qa_band}.TIF"
+    red_band_file = band_path(file, base_name, red_band, index)
+    nir_band_file = band_path(file, base_name, nir_band, index)
+    qa_band_file = band_path(file, base_name, qa_band, index)
     
     # open red, nir, and qa tif files
     red_ds = gdal.Open(red_band_file)
-    red = red_ds.GetRasterBand(1).ReadAsArray().astype(np.float32)
     nir_ds = gdal.Open(nir_band_file)
-    nir = nir_ds.GetRasterBand(1).ReadAsArray().astype(np.float32)
     qa_ds = gdal.Open(qa_band_file)
-    qa = qa_ds.GetRasterBand(1).ReadAsArray()
+    qa = qa_ds.GetRasterBand(1)
+    
+    # only read the window of the bands that covers the aoi
+    window = (0, 0, red_ds.RasterXSize, red_ds.RasterYSize)
+    if aoi is not None:
+        window = aoi_window(red_ds, aoi)
+        if window is None:
+            print(f"{base_name} does not intersect the AOI. Skipping...")
+            return None
+    gt = window_geotransform(red_ds.GetGeoTransform(), window)
     
-    # calculate cloud mask
-    # bits 3 and 4 are cloud and cloud shadow, respectively
-    cloud_bit = 1 << 3
-    cloud_shadow_bit = 1 << 4
-    bit_mask = cloud_bit | cloud_shadow_bit
-    cloud_mask = ((np.bitwise_and(qa, bit_mask) != 0) * 1).astype(np.int16)
+    # calculate cloud mask, 1 where cloudy
+    def cloud_mask(xoff, yoff, xsize, ysize):
+        return decode_qa(qa.ReadAsArray(xoff, yoff, xsize, ysize), cloud_flags)
     
-    ndvi_masked = mask_clouds_and_calc_ndvi(red, nir, cloud_mask)
-    ndvi_masked_file = f"{base_name}_NDVI_MASKED.TIF"
-    arr_to_gtiff(ndvi_masked, ndvi_masked_file, red_band_file)
+    # read and process the bands a block of rows at a time
+    ndvi_masked = mask_clouds_and_calc_ndvi_bands(red_ds.GetRasterBand(1), nir_ds.GetRasterBand(1), cloud_mask,
+                                                  window=window)
+    ndvi_masked_file = output_path(f"{base_name}_NDVI_MASKED.TIF", ndvi_masked.nbytes)
+    arr_to_gtiff(ndvi_masked, ndvi_masked_file, red_band_file, xsize=window[2], ysize=window[3], gt=gt)
     
     # free data so it saves to disk properly
-    red_ds = nir_ds = qa_ds = out_ds = outband = driver = None
+    red_ds = nir_ds = qa_ds = qa = out_ds = outband = driver = None
+    
+    return ndvi_masked_file
+
+
+""" Like calc_ndvi_and_mask_l8_clouds, but calculate several indices (names of band_math.INDICES, e.g. ['ndvi',
+    'ndmi', 'evi']) from surface reflectance, reading each band once. The indices are saved as the bands of one
+    geotiff, or as one geotiff each if separate. Returns the list of files, or None if the scene doesn't intersect
+    the aoi. """
+def calc_indices_l8(file, indices, aoi=None, index=None, separate=False):
+    expressions = index_expressions(indices)
+    base_name = os.path.splitext(os.path.basename(file))[0]
+    
+    # open the bands the indices use, and the qa band
+    qa_band_file = band_path(file, base_name, "QA_PIXEL", index)
+    qa_ds = gdal.Open(qa_band_file)
+    qa = qa_ds.GetRasterBand(1)
+    bands = {name: (open_aligned(band_path(file, base_name, sr_bands[name], index), qa_ds), sr_scale, sr_offset)
+             for name in used_bands(expressions)}
+    
+    # only read the window of the bands that covers the aoi
+    window = (0, 0, qa_ds.RasterXSize, qa_ds.RasterYSize)
+    if aoi is not None:
+        window = aoi_window(qa_ds, aoi)
+        if window is None:
+            print(f"{base_name} does not intersect the AOI. Skipping...")
+            return None
+    gt = window_geotransform(qa_ds.GetGeoTransform(), window)
     
-    return ndvi_masked_file
\ No newline at end of file
+    # calculate cloud mask, 1 where cloudy
+    def cloud_mask(xoff, yoff, xsize, ysize):
+        return decode_qa(qa.ReadAsArray(xoff, yoff, xsize, ysize), cloud_flags)
+    
+    outputs = calc_indices(bands, expressions, cloud_mask, window=window)
+    files = write_indices(outputs, base_name, qa_band_file, gt, separate)
+    
+    qa_ds = qa = bands = None
+    return files
+
+
+""" GDAL path of a band of a scene, either in the tar itself (/vsitar path) or as a byte range of the tar (with its
+    member index, see tar_index). """
+def band_path(file, base_name, band, index=None):
+    if index:
+        return member_path(file, index, f"{base_name}_{band}.TIF")
+    return f"{file}/{base_name}_{band}.TIF"
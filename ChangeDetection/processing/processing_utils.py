@@ -1,17 +1,67 @@
 import numpy as np
 
 
-""" Calculate NDVI and mask clouds given numpy arrays representing the 
+""" Calculate NDVI and mask clouds given numpy arrays representing the
     red band, NIR band, and cloud mask band of a given image. Returns
-    the result as a numpy array. """
-def mask_clouds_and_calc_ndvi(red, nir, mask):
-    # calculate NDVI
-    # TODO: this throws a warning, but the actual file looks fine. I'm guessing
-    # it has to do with the fact that the tifs are rotated--maybe numpy is padding
-    # them with zeroes to compensate, which causes some calculations to be 0/0.
-    ndvi = np.divide(np.subtract(nir, red), np.add(nir, red))
-    ndvi = np.where(ndvi == np.inf, np.nan, ndvi)
-
-    # mask clouds
-    ndvi_masked = np.where(mask, np.nan, ndvi)
-    return ndvi_masked
\ No newline at end of file
+    the result as a float32 numpy array (written to out if given).
+
+    red and nir can be any numeric type (e.g. uint16 straight from the file).
+    NDVI is computed in place in the output, block_rows rows at a time, so the
+    only temporaries are block-sized. Pixels where the mask is nonzero or
+    nir + red is 0 (e.g. the zero-filled edges of rotated scenes) are NaN. """
+def mask_clouds_and_calc_ndvi(red, nir, mask=None, out=None, block_rows=1024):
+    if out is None:
+        out = np.empty(red.shape, dtype=np.float32)
+
+    for row in range(0, red.shape[0], block_rows):
+        rows = slice(row, row + block_rows)
+        block_mask = None if mask is None else mask[rows]
+        calc_ndvi_block(red[rows], nir[rows], block_mask, out[rows])
+    return out
+
+
+""" Same as mask_clouds_and_calc_ndvi, but reads the red and NIR bands from
+    GDAL bands one block of rows at a time, so only the output is ever held in
+    memory in full. If window (xoff, yoff, xsize, ysize) is given, only that
+    part of the bands is read and processed. mask is either an array the size
+    of the output or a function mask(xoff, yoff, xsize, ysize) returning the
+    mask for a block of the bands. offset is added to the stored values of
+    both bands first (e.g. -1000 for Sentinel-2 products with an offset, see
+    s2_lambda.radiometric_offset), in which case pixels that are 0 in either
+    band (no data) are NaN too. """
+def mask_clouds_and_calc_ndvi_bands(red_band, nir_band, mask=None, block_rows=1024, window=None, offset=0):
+    xoff, yoff, xsize, ysize = window or (0, 0, red_band.XSize, red_band.YSize)
+    out = np.empty((ysize, xsize), dtype=np.float32)
+
+    for row in range(0, ysize, block_rows):
+        nrows = min(block_rows, ysize - row)
+        red = red_band.ReadAsArray(xoff, yoff + row, xsize, nrows)
+        nir = nir_band.ReadAsArray(xoff, yoff + row, xsize, nrows)
+        if callable(mask):
+            block_mask = mask(xoff, yoff + row, xsize, nrows)
+        else:
+            block_mask = None if mask is None else mask[row:row + nrows]
+        calc_ndvi_block(red, nir, block_mask, out[row:row + nrows], offset)
+    return out
+
+
+""" NDVI of one block, written in place to out. """
+def calc_ndvi_block(red, nir, mask, out, offset=0):
+    nodata = None
+    if offset:
+        nodata = (red == 0) | (nir == 0)
+        red = np.add(red, offset, dtype=np.float32)
+        nir = np.add(nir, offset, dtype=np.float32)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        diff = np.subtract(nir, red, dtype=np.float32)
+        np.add(nir, red, out=out, dtype=np.float32)
+        invalid = out == 0
+        np.divide(diff, out, out=out)
+
+    # mask 0/0 and x/0 as well as clouds
+    if mask is not None:
+        invalid |= mask != 0
+    if nodata is not None:
+        invalid |= nodata
+    out[invalid] = np.nan
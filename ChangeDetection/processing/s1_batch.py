@@ -1,15 +1,35 @@
-from pathlib import Path
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack
+import argparse
 import os
+import shutil
+import sys
+import tempfile
+import time
 
 from osgeo import gdal
 import numpy as np
 import rasterio
+from rasterio.windows import Window
 import cv2 as cv
 import boto3
-from scipy.ndimage import generic_filter
+
+from window_stats import WindowStats
+
+# allow imports from sibling directories
+sys.path.insert(0, "../util/")
+from arr_to_gtiff import gtiff_to_cog
+import db_encoding
+from granule_cache import GranuleCache
+from ledger import Ledger, list_objects
+from s3_output import output_path, remove_output, upload_output
 
 
 s3 = boto3.client('s3')
+cache = None    # optional GranuleCache for raw granules
+ledger = None   # optional Ledger of processed granules
 
 
 # Enhanced Lee Filter for speckle reduction
@@ -77,101 +97,626 @@ def enhanced_lee(img, win_size=5, num_looks=1, nodata=None):
     return img_filtered.astype(src_dtype)
 
 
-# Filter VV/VH bands using Enhanced Lee Filter
-def filter_elee(file, bands, lee_win_size=5, lee_num_looks=3):
-    filtered = []
-    # Process backscatter (VV/VH)
-    for pq in bands:
-        print(f"Processing {pq} for {file}...")
-        # Read in DN
-        basename = os.path.splitext(os.path.basename(file))[0]
-        dn_raster = f"{file}/{basename}/{basename}_{pq}.tif"
-        with rasterio.open(dn_raster) as dset:
-            dn = dset.read(1).astype(np.float64)
-            mask = dset.read_masks(1)
-            dn[mask == 0] = np.nan
-            profile = dset.profile
-
-        # Convert DN to gamma0
-        g0 = dn**2 * 100
-
-        # Filter gamma0 using enhanced Lee filter
-        g0_filtered = enhanced_lee(g0, lee_win_size, lee_num_looks, nodata=np.nan)
-
-        # Write to GeoTIFF
-        profile.update(driver='GTiff', dtype=np.float32, nodata=np.nan)
-        g0_filtered_tif = Path(f'{basename}_{pq}_FILTERED.tif')
-        with rasterio.open(g0_filtered_tif, 'w', **profile) as dset:
-            dset.write(g0_filtered.astype(np.float32), 1)
+# Enhanced Lee weighting function, computed in place on the coefficient of
+# variation ci: 1 for ci <= cu, 0 for ci >= cmax and
+# exp(-k * (ci - cu) / (cmax - ci)) in between. Clamping ci to [cu, cmax] gives
+# exactly those values without any fancy indexing, using
+# (cu - ci) / (cmax - ci) = 1 - (cmax - cu) / (cmax - ci), which is 0 at cu and
+# -inf at cmax. NaN ci (window mean of 0) gets a weight of 1.
+def lee_weights(ci, num_looks):
+    k = 1
+    cu = ci.dtype.type(0.523/np.sqrt(num_looks))
+    cmax = ci.dtype.type(np.sqrt(1 + 2/num_looks))
+
+    with np.errstate(divide='ignore'):
+        np.fmax(ci, cu, out=ci)
+        np.minimum(ci, cmax, out=ci)
+        np.subtract(cmax, ci, out=ci)
+        np.divide(cmax - cu, ci, out=ci)
+        np.subtract(1, ci, out=ci)
+        ci *= k
+        return np.exp(ci, out=ci)
+
+
+# Float32 version of enhanced_lee that keeps allocations to a minimum.
+# Works on four image-sized float32 buffers (working copy, pixel count, window
+# sum and window sum of squares) that are reused in place for every later step,
+# so it needs roughly a quarter of the memory of enhanced_lee. Pass the same
+# `out` array between calls to reuse the result buffer as well. enhanced_lee is
+# kept as the reference implementation. Results have the same NaN footprint
+# and agree to ~1e-3 (relative), since the window variance is computed in
+# float32 (see tests/test_filters.py).
+def enhanced_lee_f32(img, win_size=5, num_looks=1, nodata=None, out=None):
+    img = np.array(img, dtype=np.float32)
+
+    # Get image mask (True: nodata)
+    invalid = np.isnan(img)
+    if nodata is not None and not np.isnan(nodata):
+        invalid |= img == nodata
+
+    # Change nodata pixels to 0 so they don't contribute to the sums
+    img[invalid] = 0
+
+    ksize = (win_size, win_size)
+    if out is None:
+        out = np.empty(img.shape, dtype=np.float32)
+
+    # Pixel number, window sum and window sum of squares. boxFilter accumulates
+    # float32 input in double precision, so the sums don't drift.
+    pix_num = np.logical_not(invalid).astype(np.float32)
+    del invalid
+    cv.boxFilter(pix_num, -1, ksize, dst=pix_num,
+                 normalize=False, borderType=cv.BORDER_ISOLATED)
+    img_sum = cv.boxFilter(img, -1, ksize, dst=out,
+                           normalize=False, borderType=cv.BORDER_ISOLATED)
+    img2_sum = np.multiply(img, img)
+    cv.boxFilter(img2_sum, -1, ksize, dst=img2_sum,
+                 normalize=False, borderType=cv.BORDER_ISOLATED)
 
-        filtered.append(str(g0_filtered_tif))
-    
-    return filtered
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # E[X] and E[X^2]; windows without data become NaN
+        img_mean = np.divide(img_sum, pix_num, out=img_sum)
+        img2_mean = np.divide(img2_sum, pix_num, out=img2_sum)
 
+        # Coefficient of variation sqrt(E[X^2] - (E[X])^2) / E[X]. Clamping the
+        # variance at 0 replaces the np.isclose correction in enhanced_lee.
+        ci = img2_mean
+        ci -= np.square(img_mean, out=pix_num)
+        np.maximum(ci, 0, out=ci)
+        np.sqrt(ci, out=ci)
+        ci /= img_mean
 
-# Filter INC_MAP by calculating standard deviation of neighborhood of pixels
-def filter_std(file, bands, window_size=5):
-    filtered = []
-
-    for pq in bands:
-        print(f"Processing {pq} for {file}...")
-        # Read in DN
-        basename = os.path.splitext(os.path.basename(file))[0]
-        dn_raster = f"{file}/{basename}/{basename}_{pq}.tif"
-        with rasterio.open(dn_raster) as dset:
-            dn = dset.read(1).astype(np.float64)
-            mask = dset.read_masks(1)
-            dn[mask == 0] = np.nan
-            profile = dset.profile
-
-        dn_filtered = generic_filter(dn, np.std, window_size, mode='nearest')
-
-        # Write to GeoTIFF
+        w_t = lee_weights(ci, num_looks)
+
+    # Apply weighting function: mean * w + img * (1 - w) = img + w * (mean - img)
+    img_filtered = np.subtract(img_mean, img, out=img_mean)
+    img_filtered *= w_t
+    img_filtered += img
+
+    # Assign nodata value (windows without data are already NaN)
+    if nodata is not None and not np.isnan(nodata):
+        img_filtered[np.isnan(img_filtered)] = nodata
+
+    return img_filtered
+
+
+# Enhanced Lee filter using precomputed window statistics. Build stats once per
+# band with WindowStats(img, nodata) and pass them in to try several window
+# sizes without recomputing the sums. Same results as enhanced_lee, but all
+# window statistics are accumulated in float64 summed-area tables.
+def enhanced_lee_sat(img, win_size=5, num_looks=1, nodata=None, stats=None):
+    if stats is None:
+        stats = WindowStats(img, nodata)
+
+    src_dtype = img.dtype
+    img = img.astype(np.float64)
+
+    # Change nodata pixels to 0, like enhanced_lee
+    invalid = np.isnan(img)
+    if nodata is not None and not np.isnan(nodata):
+        invalid |= img == nodata
+    img[invalid] = 0
+
+    # Windows without data have a NaN mean, so they end up NaN below
+    _, img_mean, ci = stats.window_stats(win_size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np.sqrt(ci, out=ci)
+        ci /= img_mean
+    w_t = lee_weights(ci, num_looks)
+
+    # Apply weighting function
+    img_filtered = np.subtract(img_mean, img, out=img_mean)
+    img_filtered *= w_t
+    img_filtered += img
+
+    # Assign nodata value
+    if nodata is not None and not np.isnan(nodata):
+        img_filtered[np.isnan(img_filtered)] = nodata
+
+    return img_filtered.astype(src_dtype)
+
+
+# Moving standard deviation using the same box-sum / sum-of-squares approach as
+# enhanced_lee, as a fast replacement for generic_filter(img, np.std, ...).
+# Edges are handled like mode='nearest' (edge pixels are repeated). NaN and
+# nodata pixels are left out of the window statistics instead of spreading to
+# their neighbours, and stay nodata in the output.
+# Precomputed stats can be passed in (built with WindowStats(img, nodata,
+# pad=win_size // 2)) to reuse them across window sizes or other features.
+def moving_std(img, win_size=5, nodata=None, stats=None):
+    src_dtype = img.dtype
+    if stats is not None:
+        img_std = stats.std(win_size, mode='nearest')
+        invalid = np.isnan(img)
+        if nodata is not None and not np.isnan(nodata):
+            invalid |= img == nodata
+        img_std[invalid] = np.nan if nodata is None else nodata
+        return img_std.astype(src_dtype)
+
+    img = img.astype(np.float64)
+
+    # Get image mask (0: nodata; 1: data)
+    invalid = np.isnan(img)
+    if nodata is not None and not np.isnan(nodata):
+        invalid |= img == nodata
+    mask = np.logical_not(invalid).astype(np.float64)
+
+    # Shift by the image mean so E[X^2] - (E[X])^2 doesn't lose precision
+    # on bands with a large offset and little variation (e.g. incidence angle)
+    img[invalid] = np.nan
+    if np.any(mask):
+        img -= np.nanmean(img)
+    img[invalid] = 0
+
+    # Window sums, pixel counts and std within the window
+    ksize = (win_size, win_size)
+    img_sum = cv.boxFilter(img, -1, ksize,
+                           normalize=False, borderType=cv.BORDER_REPLICATE)
+    img2_sum = cv.boxFilter(np.square(img, out=img), -1, ksize,
+                            normalize=False, borderType=cv.BORDER_REPLICATE)
+    pix_num = cv.boxFilter(mask, -1, ksize,
+                           normalize=False, borderType=cv.BORDER_REPLICATE)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        img_mean = np.divide(img_sum, pix_num, out=img_sum)
+        img_var = np.divide(img2_sum, pix_num, out=img2_sum)
+        img_var -= np.square(img_mean, out=img_mean)
+        np.maximum(img_var, 0, out=img_var)
+        img_std = np.sqrt(img_var, out=img_var)
+
+    # Assign nodata value
+    img_std[invalid] = np.nan if nodata is None else nodata
+
+    return img_std.astype(src_dtype)
+
+
+# Yield (read window, write window, interior slices) for each block of a raster.
+# Read windows are padded by a halo on every side (clipped at the raster edges)
+# so windowed filters see the same neighbourhood they would on the full array.
+def halo_windows(width, height, block_size, halo):
+    for row in range(0, height, block_size):
+        for col in range(0, width, block_size):
+            nrows = min(block_size, height - row)
+            ncols = min(block_size, width - col)
+            row0 = max(row - halo, 0)
+            col0 = max(col - halo, 0)
+            row1 = min(row + nrows + halo, height)
+            col1 = min(col + ncols + halo, width)
+
+            read_win = Window(col0, row0, col1 - col0, row1 - row0)
+            write_win = Window(col, row, ncols, nrows)
+            interior = (slice(row - row0, row - row0 + nrows),
+                        slice(col - col0, col - col0 + ncols))
+            yield read_win, write_win, interior
+
+
+# GDAL settings for reading HyP3 zips over /vsis3: don't list the archive to
+# probe for sidecar files (.aux.xml, .ovr, .msk) on every open, cache remote
+# reads so the zip central directory and TIFF headers are only fetched once,
+# and fetch in large chunks since every band is read from start to end anyway
+# (GDAL otherwise starts over at 16 KB requests for each band it opens).
+GRANULE_ENV = {
+    'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+    'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': '.zip,.tif',
+    'CPL_VSIL_CURL_CHUNK_SIZE': str(4 * 1024 * 1024),
+    'CPL_VSIL_CURL_CACHE_SIZE': str(64 * 1024 * 1024),
+    'VSI_CACHE': 'TRUE',
+}
+
+
+# Read a window (or all) of several open bands into one float32 stack with a
+# shared mask: a pixel that is nodata in any band is set to NaN in every band.
+# The mask comes from each band's nodata value, so the data isn't read twice.
+def read_bands(datasets, window=None):
+    if window is None:
+        shape = (datasets[0].height, datasets[0].width)
+    else:
+        shape = (window.height, window.width)
+
+    stack = np.empty((len(datasets),) + shape, dtype=np.float32)
+    invalid = np.zeros(shape, dtype=bool)
+    for band, dset in zip(stack, datasets):
+        dset.read(1, window=window, out=band)
+        if dset.nodata is not None:
+            invalid |= band == dset.nodata
+        else:
+            invalid |= dset.read_masks(1, window=window) == 0
+        invalid |= np.isnan(band)
+
+    np.copyto(stack, np.nan, where=invalid)
+    return stack, invalid
+
+
+# Filter the bands of a granule in a single pass: every band is opened once,
+# read together with a shared mask and written to {basename}_{band}_FILTERED.tif.
+# lee_bands (VV/VH DN) are converted to gamma0 in place and filtered with the
+# Enhanced Lee kernel; std_bands (INC_MAP) get a moving standard deviation.
+# If block_size is set, the bands are read, filtered and written one block at a
+# time (plus a halo of half the largest window), so memory use depends on the
+# block size rather than the granule size. Since the filters only look half a
+# window away and the halo is clipped at the real raster edges, the output is
+# the same as filtering the whole band at once.
+# The bands are written to intermediate GeoTIFFs and then converted to
+# Cloud-Optimized GeoTIFFs (tiled, compressed, with overviews), since COGs
+# can't be written block by block. The parts and COGs of all bands are kept in
+# /vsimem at once, so they share one MAX_MEM_OUTPUT_MB budget (see s3_output):
+# if they don't all fit, they all go to disk.
+# With encoding='db' the lee_bands are stored as uint16 dB (see db_encoding)
+# instead of float32 linear gamma0, which halves their size.
+def filter_granule(file, lee_bands=('VV', 'VH'), std_bands=('inc_map',), lee_win_size=5,
+                   lee_num_looks=3, std_win_size=5, block_size=None, kernel=enhanced_lee_f32,
+                   encoding='float32'):
+    basename = os.path.splitext(os.path.basename(file))[0]
+    bands = list(lee_bands) + list(std_bands)
+    print(f"Processing {', '.join(bands)} for {file}...")
+
+    with rasterio.Env(**GRANULE_ENV), ExitStack() as stack:
+        srcs = [stack.enter_context(rasterio.open(f"{file}/{basename}/{basename}_{pq}.tif"))
+                for pq in bands]
+
+        nbytes = 2 * len(bands) * srcs[0].width * srcs[0].height * np.dtype(np.float32).itemsize
+        outputs = [output_path(f'{basename}_{pq}_FILTERED.tif', nbytes) for pq in bands]
+        parts = [output_path(f'{basename}_{pq}_FILTERED.part.tif', nbytes) for pq in bands]
+
+        profile = srcs[0].profile
         profile.update(driver='GTiff', dtype=np.float32, nodata=np.nan)
-        dn_filtered_tif = Path(f'{basename}_{pq}_FILTERED.tif')
-        with rasterio.open(dn_filtered_tif, 'w', **profile) as dset:
-            dset.write(dn_filtered.astype(np.float32), 1)
+        if block_size and block_size % 16 == 0:
+            profile.update(tiled=True, blockxsize=block_size, blockysize=block_size)
+        db_profile = dict(profile, dtype=np.uint16, nodata=db_encoding.NODATA)
+
+        dsts = []
+        for i, part in enumerate(parts):
+            encoded = encoding == 'db' and i < len(lee_bands)
+            dst = stack.enter_context(rasterio.open(part, 'w', **(db_profile if encoded else profile)))
+            if encoded:
+                dst.scales = (db_encoding.DB_SCALE,)
+                dst.offsets = (db_encoding.DB_OFFSET,)
+                dst.units = ('dB',)
+                dst.update_tags(1, ENCODING=db_encoding.ENCODING)
+            dsts.append(dst)
+
+        if block_size:
+            halo = 0
+            if lee_bands:
+                halo = lee_win_size // 2
+            if std_bands:
+                halo = max(halo, std_win_size // 2)
+            windows = halo_windows(srcs[0].width, srcs[0].height, block_size, halo)
+        else:
+            windows = [(None, None, (slice(None), slice(None)))]
+
+        for read_win, write_win, interior in windows:
+            data, _ = read_bands(srcs, read_win)
+            for i, (band, dst) in enumerate(zip(data, dsts)):
+                if i < len(lee_bands):
+                    # Convert DN to gamma0 in place and filter it
+                    np.square(band, out=band)
+                    band *= 100
+                    band_filtered = kernel(band, lee_win_size, lee_num_looks, nodata=np.nan)
+                    if encoding == 'db':
+                        band_filtered = db_encoding.encode_db(band_filtered)
+                else:
+                    band_filtered = moving_std(band, std_win_size, nodata=np.nan)
+                dst.write(band_filtered[interior].astype(dst.dtypes[0], copy=False), 1, window=write_win)
+
+    for part, out in zip(parts, outputs):
+        gtiff_to_cog(part, out)
+        remove_output(part)
+
+    return outputs
 
-        filtered.append(str(dn_filtered_tif))
-    return filtered
 
+# Filter VV/VH bands using Enhanced Lee Filter
+# kernel selects the filter implementation (enhanced_lee_f32 or enhanced_lee).
+def filter_elee(file, bands, lee_win_size=5, lee_num_looks=3, block_size=None,
+                kernel=enhanced_lee_f32, encoding='float32'):
+    return filter_granule(file, lee_bands=bands, std_bands=(), lee_win_size=lee_win_size,
+                          lee_num_looks=lee_num_looks, block_size=block_size, kernel=kernel,
+                          encoding=encoding)
 
-def process(zipfile):
+
+# Filter INC_MAP by calculating standard deviation of neighborhood of pixels
+def filter_std(file, bands, window_size=5, block_size=None):
+    return filter_granule(file, lee_bands=(), std_bands=bands, std_win_size=window_size,
+                          block_size=block_size)
+
+
+# Filter parameters for each output band of a granule. These are recorded in
+# the processing ledger, so changing them re-processes only the affected bands.
+# The encoding is only recorded when it isn't the default float32.
+def band_params(lee_win_size=5, lee_num_looks=3, std_win_size=5, encoding='float32'):
+    lee = {'filter': 'enhanced_lee_f32', 'win_size': lee_win_size, 'num_looks': lee_num_looks}
+    if encoding != 'float32':
+        lee['encoding'] = encoding
+    return {
+        'VV': lee,
+        'VH': lee,
+        'INC': {'filter': 'moving_std', 'win_size': std_win_size},
+    }
+
+
+# src is the GDAL path to read the granule from (default: straight from s3).
+# params maps the bands to produce to their filter parameters (see band_params,
+# default: all bands). If etag is given, progress is recorded in the ledger.
+def process(zipfile, block_size=None, src=None, params=None, etag=None):
     basename = os.path.splitext(os.path.basename(zipfile))[0]
     dirname = os.path.dirname(zipfile)
+    if not src:
+        src = f"/vsizip/vsis3/{zipfile}"
+    if not params:
+        params = band_params()
     print(f"Processing {basename}...")
 
-    # enhanced lee filter
-    bands = ['VV', 'VH']
-    processed = filter_elee(f"/vsizip/vsis3/{zipfile}", bands)
-
-    # skip INC band for now
-    # bands = ['INC']
-    # processed.append(filter_std(f"/vsizip/vsis3/{zipfile}", ['inc_map']))
-
-    # upload to s3
-    dst_bucket = "processed-granules"
-    
-    for file, postfix in zip(processed, bands):
-        bucket, prefix = dirname.split('/', 1)
-        key = f"{prefix}/{basename}/{basename}_{postfix}_FILTERED.tif"
-        s3.upload_file(file, dst_bucket, key)
-        print(f"Uploaded {key} to {dst_bucket}")
-        os.remove(file)
+    record = ledger is not None and etag is not None
+    bands = list(params)
+    if record:
+        for postfix in bands:
+            ledger.start(zipfile, etag, postfix, params[postfix])
+
+    try:
+        # enhanced lee filter (VV/VH) and incidence angle texture (INC), read in one pass
+        lee_bands = [band for band in bands if band in ('VV', 'VH')]
+        std_bands = ['inc_map'] if 'INC' in bands else []
+        lee_params = params[lee_bands[0]] if lee_bands else {}
+        std_params = params.get('INC', {})
+        bands = lee_bands + ['INC'] * len(std_bands)
+        processed = filter_granule(src, lee_bands, std_bands,
+                                   lee_win_size=lee_params.get('win_size', 5),
+                                   lee_num_looks=lee_params.get('num_looks', 3),
+                                   std_win_size=std_params.get('win_size', 5),
+                                   block_size=block_size,
+                                   encoding=lee_params.get('encoding', 'float32'))
+
+        # upload to s3
+        dst_bucket = "processed-granules"
+
+        for file, postfix in zip(processed, bands):
+            bucket, prefix = dirname.split('/', 1)
+            key = f"{prefix}/{basename}/{basename}_{postfix}_FILTERED.tif"
+            upload_output(file, dst_bucket, key, s3)
+            print(f"Uploaded {key} to {dst_bucket}")
+            if record:
+                ledger.finish(zipfile, postfix, f"{dst_bucket}/{key}")
+    except Exception as e:
+        if record:
+            for postfix in bands:
+                if postfix in ledger.pending(zipfile, etag, {postfix: params[postfix]}):
+                    ledger.fail(zipfile, postfix, e)
+        raise
+
+
+# Give each worker process its own GDAL cache budget, s3 client, directory for
+# downloaded granules and handles on the (shared) raw granule cache and
+# processing ledger
+def init_worker(gdal_cache_mb, tmp_root, cache_dir=None, cache_bytes=None, ledger_path=None):
+    global s3, cache, ledger, prefetcher, tmp_dir
+    os.environ['GDAL_CACHEMAX'] = str(gdal_cache_mb)
+    gdal.SetCacheMax(gdal_cache_mb * 1024 * 1024)
+    s3 = boto3.client('s3')
+    if cache_dir:
+        cache = GranuleCache(cache_dir, cache_bytes, s3)
+    if ledger_path:
+        ledger = Ledger(ledger_path)
+    prefetcher = ThreadPoolExecutor(max_workers=1)
+    tmp_dir = tempfile.mkdtemp(dir=tmp_root)
+
+
+# set up by init_worker in each worker process
+prefetcher = None   # background thread downloading the next granule
+prefetched = {}     # zipfile -> future of its local copy
+tmp_dir = None
+
+
+# Get a local copy of a raw granule: from the granule cache if there is one,
+# otherwise downloaded into a new directory under tmp_dir
+def fetch_granule(zipfile, tmp_dir, etag=None):
+    bucket, key = zipfile.split('/', 1)
+    if cache:
+        return cache.get(bucket, key, etag)
+    local = os.path.join(tempfile.mkdtemp(dir=tmp_dir), os.path.basename(key))
+    s3.download_file(bucket, key, local)
+    return local
+
+
+# Counterpart of fetch_granule, once the local copy isn't needed anymore
+def release_granule(local):
+    if cache:
+        cache.release(local)
+    else:
+        shutil.rmtree(os.path.dirname(local), ignore_errors=True)
+
+
+# Process one job (zipfile, etag, params) in a worker. next_job is the job this
+# worker will most likely get next (see process_parallel): it's downloaded in a
+# background thread while the current granule is being filtered. Failures are
+# returned as results instead of being raised, so one bad granule doesn't stop
+# the rest.
+def process_job(job, next_job=None, block_size=None):
+    zipfile, etag, params = job
+    start = time.perf_counter()
+    if next_job and next_job[0] not in prefetched:
+        prefetched[next_job[0]] = prefetcher.submit(fetch_granule, next_job[0], tmp_dir, next_job[1])
+    pending = prefetched.pop(zipfile, None)
+    drop_prefetched(keep=next_job[0] if next_job else None)
+
+    try:
+        local = pending.result() if pending else fetch_granule(zipfile, tmp_dir, etag)
+    except Exception as e:
+        print(f"Failed to download {zipfile}: {e}")
+        return (zipfile, "failed", time.perf_counter() - start, str(e))
+
+    try:
+        process(zipfile, block_size, src=f"/vsizip/{local}", params=params, etag=etag)
+        return (zipfile, "ok", time.perf_counter() - start, "")
+    except Exception as e:
+        print(f"Failed to process {zipfile}: {e}")
+        return (zipfile, "failed", time.perf_counter() - start, str(e))
+    finally:
+        release_granule(local)
+
+
+# Release finished prefetches of granules that ended up on another worker
+def drop_prefetched(keep=None):
+    for zipfile, pending in list(prefetched.items()):
+        if zipfile != keep and pending.done():
+            del prefetched[zipfile]
+            if pending.exception() is None:
+                release_granule(pending.result())
+
+
+# Process jobs in a pool of worker processes, one granule per task.
+# Every task also reserves the next job in the queue as its follow-up, which
+# its worker prefetches, and the follow-up is submitted as soon as the task is
+# done, i.e. while that worker is the idle one. If a worker dies outright (e.g.
+# killed for running out of memory) the pool breaks and every task still in it
+# fails: only those granules are recorded as failed (granules that finished
+# before keep their results), and the pool is rebuilt for the rest of the queue.
+def process_parallel(jobs, workers, block_size=None, gdal_cache_mb=512,
+                     cache_dir=None, cache_bytes=None, ledger_path=None):
+    queue = deque(jobs)
+    results = []
+    with tempfile.TemporaryDirectory(dir='.') as tmp_root:
+        initargs = (gdal_cache_mb, os.path.abspath(tmp_root), cache_dir, cache_bytes, ledger_path)
+        while queue:
+            results.extend(run_pool(queue, workers, block_size, initargs))
+    return results
+
+
+# Run jobs from queue in a new pool until the queue is empty or the pool breaks
+def run_pool(queue, workers, block_size, initargs):
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=initargs) as pool:
+        futures = {}
+
+        def submit(job):
+            next_job = queue.popleft() if queue else None
+            futures[pool.submit(process_job, job, next_job, block_size)] = (job, next_job)
+
+        for _ in range(workers):
+            if queue:
+                submit(queue.popleft())
+
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            broken = [future for future in done if isinstance(future.exception(), BrokenProcessPool)]
+            # keep the results of the jobs that finished before the pool broke
+            for future in done:
+                if future in broken:
+                    continue
+                job, next_job = futures.pop(future)
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    results.append(job_failed(job, e))
+                if next_job and broken:
+                    queue.appendleft(next_job)
+                elif next_job:
+                    submit(next_job)
+            if broken:
+                # a worker died: record the granules that were still in flight,
+                # and put the follow-ups back in the queue for a new pool
+                error = broken[0].exception()
+                print(f"Worker failed: {error}")
+                lost = list(futures.values())
+                futures.clear()
+                for lost_job, lost_next in reversed(lost):
+                    results.append(job_failed(lost_job, error))
+                    if lost_next:
+                        queue.appendleft(lost_next)
+                return results
+    return results
+
+
+# Result of a job that failed outside of process_job, also recorded in the ledger
+def job_failed(job, error):
+    zipfile, etag, params = job
+    if ledger is not None and etag is not None:
+        for postfix in params:
+            if postfix in ledger.pending(zipfile, etag, {postfix: params[postfix]}):
+                ledger.fail(zipfile, postfix, error)
+    return (zipfile, "failed", 0.0, str(error))
+
+
+def print_summary(results):
+    print(f"{'status':<8} {'seconds':>8}  granule")
+    for zipfile, status, seconds, error in sorted(results):
+        print(f"{status:<8} {seconds:>8.1f}  {zipfile}  {error}")
+    failed = sum(1 for result in results if result[1] != "ok")
+    print(f"Processed {len(results) - failed}/{len(results)} granules ({failed} failed).")
 
 
 def main():
+    global cache, ledger
+    parser = argparse.ArgumentParser(
+        description="Filter Sentinel-1 RTC granules and upload them to s3.")
+
+    parser.add_argument("--block-size", type=int, default=None,
+                        help="filter granules in blocks of this many pixels (default: whole band at once)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of granules to process in parallel (default: 1)")
+    parser.add_argument("--gdal-cache", type=int, default=512,
+                        help="GDAL block cache per worker in MB, when using --workers (default: 512)")
+    parser.add_argument("--cache-dir", type=str, default=None,
+                        help="keep local copies of raw granules in this directory (default: no cache)")
+    parser.add_argument("--cache-size", type=float, default=50,
+                        help="maximum size of the raw granule cache in GB (default: 50)")
+    parser.add_argument("--ledger", type=str, default=None,
+                        help="sqlite file to record processed granules in, so re-runs only process "
+                             "new or changed granules and bands (default: skip granules with existing outputs)")
+    parser.add_argument("--lee-win-size", type=int, default=5,
+                        help="window size of the Enhanced Lee filter (default: 5)")
+    parser.add_argument("--lee-num-looks", type=int, default=3,
+                        help="number of looks for the Enhanced Lee filter (default: 3)")
+    parser.add_argument("--std-win-size", type=int, default=5,
+                        help="window size of the INC moving standard deviation (default: 5)")
+    parser.add_argument("--encoding", choices=['float32', 'db'], default='float32',
+                        help="storage of the filtered VV/VH bands: float32 linear gamma0, or "
+                             "uint16 dB at half the size (default: float32)")
+    args = parser.parse_args()
+    cache_bytes = int(args.cache_size * 1024**3)
+    params = band_params(args.lee_win_size, args.lee_num_looks, args.std_win_size, args.encoding)
+
     src_bucket = "raw-granules"
-    # avoid re-processing existing tifs for now
-    existing = s3.list_objects(Bucket='processed-granules', Prefix='s1')['Contents']
-    existing = set([os.path.dirname(file['Key']) for file in existing])
-    for file in s3.list_objects(Bucket=src_bucket, Prefix="s1")['Contents']:
-        file = file['Key']
-        if file[:-4] not in existing:
-            filepath = src_bucket + '/' + file
-            process(filepath)
+    jobs = []
+    if args.ledger:
+        # only process granules (and bands) that are new, changed, or were processed
+        # with different parameters
+        ledger = Ledger(args.ledger)
+        for key, etag in list_objects(s3, src_bucket, "s1"):
+            if not key.endswith('.zip'):
+                continue
+            zipfile = f"{src_bucket}/{key}"
+            todo = ledger.pending(zipfile, etag, params)
+            if todo:
+                jobs.append((zipfile, etag, {band: params[band] for band in todo}))
+    else:
+        # avoid re-processing existing tifs for now
+        existing = s3.list_objects(Bucket='processed-granules', Prefix='s1')['Contents']
+        existing = set([os.path.dirname(file['Key']) for file in existing])
+        for file in s3.list_objects(Bucket=src_bucket, Prefix="s1")['Contents']:
+            file = file['Key']
+            if file[:-4] not in existing:
+                filepath = src_bucket + '/' + file
+                jobs.append((filepath, None, params))
+
+    if args.workers > 1:
+        results = process_parallel(jobs, args.workers, args.block_size, args.gdal_cache,
+                                   args.cache_dir, cache_bytes, args.ledger)
+        print_summary(results)
+    else:
+        if args.cache_dir:
+            cache = GranuleCache(args.cache_dir, cache_bytes, s3)
+        for zipfile, etag, job_params in jobs:
+            if cache:
+                bucket, key = zipfile.split('/', 1)
+                with cache.local_copy(bucket, key, etag) as local:
+                    process(zipfile, args.block_size, f"/vsizip/{local}", job_params, etag)
+            else:
+                process(zipfile, args.block_size, params=job_params, etag=etag)
+        if cache:
+            print(f"Granule cache: {cache.hits} hits, {cache.misses} misses")
     print("Done.")
             
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,3 +1,4 @@
+import argparse
 import os
 import sys
 
@@ -6,46 +7,145 @@ import botocore
 
 # allow imports from sibling directories
 sys.path.insert(0, "../util/")
-from s2_lambda import calc_ndvi_and_mask_s2_clouds
+from s2_lambda import calc_ndvi_and_mask_s2_clouds, calc_indices_s2, reflectance_bands
+from ledger import Ledger
+from s3_output import upload_output
+from band_math import index_expressions, used_bands
+import batch_driver
 
+# cloud masks of a granule, of which it has the one of its processing baseline
+# (see s2_lambda.granule_cloud_mask)
+cloud_mask_files = ["MSK_CLASSI_B00.jp2", "MSK_CLOUDS_B00.gml"]
 
-def main():
-    src_bucket = "raw-granules"
-    dest_bucket = "processed-granules"
-    s3 = boto3.client('s3')
-
-    response = s3.list_objects(Bucket=src_bucket, Prefix="s2-l1c")
-    granules = []
-    for key in response['Contents']:
-            path = os.path.dirname(key['Key'])
-            granule = f"{src_bucket}/{path}/{os.path.basename(path)}"
-            try:
-                # check if file already exists
-                s3.head_object(Bucket=dest_bucket, Key=f"{path}_NDVI_MASKED.TIF")
-            except botocore.exceptions.ClientError as e:
-                if e.response['Error']['Code'] == "404":
-                    granules.append(granule)
-                else:
-                    raise e
-
-    granules = set(granules)
-    for granule in granules:
-        prefix = granule.split('/', 1)
-        bucket = prefix[0]
-        key = prefix[1]
+# files calc_ndvi_and_mask_s2_clouds reads for each granule (see files_of for
+# calc_indices_s2)
+s2_files = ["B04.jp2", "B08.jp2"] + cloud_mask_files
+
+# processing parameters recorded in the ledger for each granule
+ndvi_params = {'index': 'ndvi', 'cloud_mask': 'MSK_CLOUDS_B00|MSK_CLASSI_B00'}
+
+src_bucket = "raw-granules"
+dest_bucket = "processed-granules"
+
+# name of the (first) output of each granule (see batch_driver.product_of), set by main
+product = None
+
+
+""" Get local copies of the files of a Sentinel-2 granule from the cache and
+    return the local prefix to pass to calc_ndvi_and_mask_s2_clouds, along with
+    the paths to release once the granule is processed. Files that don't exist
+    (e.g. the cloud mask of the other processing baseline) are skipped. """
+def cache_s2_granule(cache, bucket, key):
+    paths = []
+    for file in s2_files:
+        try:
+            paths.append(cache.get(bucket, f"{key}_{file}"))
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] not in ("404", "NoSuchKey"):
+                for path in paths:
+                    cache.release(path)
+                raise e
+    return os.path.join(cache.cache_dir, bucket, key), paths
+
+
+""" Granule (bucket/prefix of its files) of a source key, or None for files
+    calc_ndvi_and_mask_s2_clouds doesn't read. """
+def granule_of(key):
+    if not any(key.endswith(f"_{file}") for file in s2_files):
+        return None
+    path = os.path.dirname(key)
+    return f"{src_bucket}/{path}/{os.path.basename(path)}"
+
+
+""" Files calc_indices_s2 reads for each granule: the bands the indices use,
+    B04 (which sets the output grid) and the cloud masks. """
+def files_of(indices):
+    bands = {reflectance_bands[name] for name in used_bands(index_expressions(indices))}
+    return sorted(bands | {reflectance_bands['red']}) + cloud_mask_files
+
+
+""" Output key of a granule. """
+def output_of(granule):
+    key = granule.split('/', 1)[1]
+    return f"{os.path.dirname(key)}_{product}.TIF"
+
+
+""" batch_driver.init_worker, plus the files to cache for the indices. """
+def init_worker(*args):
+    global s2_files
+    batch_driver.init_worker(*args)
+    if batch_driver.indices:
+        s2_files = files_of(batch_driver.indices)
+
+
+""" Calculate NDVI (or the indices) for a granule and upload it, using the
+    state set up by init_worker. Returns the (first) output, or None if the
+    granule doesn't intersect the aoi. """
+def process_granule(granule, etag):
+    s3, cache = batch_driver.s3, batch_driver.cache
+    bucket, key = granule.split('/', 1)
+    if cache:
+        # read the granule from local copies instead
+        local, paths = cache_s2_granule(cache, bucket, key)
+        try:
+            results = calc_granule(local)
+        finally:
+            for path in paths:
+                cache.release(path)
+    else:
         # vsis3 tells gdal that the file is in an s3 bucket
-        result = calc_ndvi_and_mask_s2_clouds(f"/vsis3/{bucket}/{key}")
-        if result:
-            print(f"Generated {result}")
-        
-            # remove redundant folder name from uploaded file
-            prefix = os.path.dirname(os.path.dirname(key))
-            key = f"{prefix}/{result}"
-            s3.upload_file(result, dest_bucket, key)
-            print(f"Uploaded {key} to {dest_bucket}")
-            os.remove(result)
-    
-    print(f"Processed {len(granules)} granules.")
+        results = calc_granule(f"/vsis3/{bucket}/{key}")
+    if not results:
+        return None
+
+    # remove redundant folder name from uploaded file
+    prefix = os.path.dirname(os.path.dirname(key))
+    outputs = []
+    for result in results:
+        print(f"Generated {result}")
+        key = f"{prefix}/{os.path.basename(result)}"
+        upload_output(result, dest_bucket, key, s3)
+        print(f"Uploaded {key} to {dest_bucket}")
+        outputs.append(f"{dest_bucket}/{key}")
+    return outputs[0]
+
+
+""" Calculate NDVI or the indices for a granule, returns the files (or None). """
+def calc_granule(file):
+    if batch_driver.indices:
+        return calc_indices_s2(file, batch_driver.indices, batch_driver.aoi, batch_driver.separate)
+    result = calc_ndvi_and_mask_s2_clouds(file, batch_driver.aoi)
+    return [result] if result else None
+
+
+def main():
+    global s2_files, product
+    parser = argparse.ArgumentParser(
+        description="Calculate NDVI (or other indices, from top of atmosphere or, for L2A, surface reflectance) "
+                    "and mask clouds for unprocessed Sentinel-2 granules.")
+    batch_driver.add_arguments(parser)
+    args = parser.parse_args()
+    params = batch_driver.run_params(ndvi_params, args)
+
+    # granule_of and output_of run here, in the main thread
+    if args.indices:
+        s2_files = files_of(args.indices)
+    product = batch_driver.product_of(args.indices, args.separate)
+
+    ledger = None
+    if args.ledger:
+        # only process granules that are new, changed, or were processed with different parameters.
+        # a granule's etag combines the etags of all of its input files
+        ledger = Ledger(args.ledger)
+
+    granules = batch_driver.find_pending(boto3.client('s3'), src_bucket, "s2-l1c", granule_of,
+                                         dest_bucket, "s2-l1c", output_of,
+                                         ledger=ledger, product=product, params=params)
+    print(f"Found {len(granules)} granules to process.")
+
+    batch_driver.run_batch(granules, process_granule, args.workers, args.pool,
+                           initializer=init_worker, initargs=batch_driver.init_args(args),
+                           ledger=ledger, product=product, params=params)
 
 
 if __name__ == "__main__":
@@ -1,86 +1,345 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
+import re
 import sys
+import threading
 
 from osgeo import gdal
-import numpy as np
+from osgeo import ogr
 import boto3
 
 # sys.path.insert(0, "../util/") # only needed if running locally
-from processing_utils import mask_clouds_and_calc_ndvi
+from processing_utils import mask_clouds_and_calc_ndvi_bands
 from arr_to_gtiff import arr_to_gtiff
+from s3_output import output_path, upload_output
+from aoi import load_aoi, aoi_window, window_geotransform
+from band_math import calc_indices, index_expressions, open_aligned, used_bands, write_indices
 
+# parsed cloud masks (see load_cloud_mask) per mask file, i.e. per tile and
+# date, so they survive between invocations of a warm lambda
+cloud_masks = {}
+max_cloud_masks = 32
+cloud_masks_lock = threading.Lock()
+# VSIE_AWSObjectNotFound, the error of a stat of a missing object in s3 (a stat
+# of a missing file may also set no error at all)
+vsi_object_not_found = 8
 
+# memory (mb) a record needs at most for each output: a float32 array for a full
+# 10980x10980 tile, plus the output geotiff, which is kept in /vsimem up to
+# MAX_MEM_OUTPUT_MB (see s3_output). the python runtime, gdal and boto3 need
+# about runtime_memory_mb on top of the records
+tile_output_mb = 10980 * 10980 * 4 // 2**20
+runtime_memory_mb = 256
+
+
+""" Memory (mb) processing one record can take: tile_output_mb for every index (see INDICES), or for NDVI, and
+    the largest output kept in memory. """
+def record_memory_mb():
+    outputs = len(os.environ["INDICES"].split(',')) if os.environ.get("INDICES") else 1
+    largest_output_mb = tile_output_mb if os.environ.get("SEPARATE_INDICES") == "1" else outputs * tile_output_mb
+    return outputs * tile_output_mb + min(largest_output_mb, int(os.environ.get("MAX_MEM_OUTPUT_MB", 512)))
+
+
+""" Number of records of an SQS batch to process at once: MAX_WORKERS, or as many as fit in the memory of the
+    lambda (AWS_LAMBDA_FUNCTION_MEMORY_SIZE), at least 1. """
+def default_max_workers():
+    if os.environ.get("MAX_WORKERS"):
+        return int(os.environ["MAX_WORKERS"])
+    memory_mb = int(os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", 1024))
+    return max(1, (memory_mb - runtime_memory_mb) // record_memory_mb())
+
+
+max_workers = default_max_workers()
+
+# public Sentinel-2 buckets (requester pays) that tiles can be read from in
+# place, and the prefix of their outputs in processed-granules
+source_buckets = {"sentinel-s2-l1c": "s2-l1c", "sentinel-s2-l2a": "s2-l2a"}
+source_tile_pattern = re.compile(r"tiles/(?P<utm>\d{1,2})/(?P<lat>\w)/(?P<square>\w{2})/"
+                                 r"(?P<year>\d{4})/(?P<month>\d{1,2})/(?P<day>\d{1,2})/(?P<sequence>\d+)/?$")
+
+# reading from the public buckets is billed to us. the header is ignored by our
+# own buckets, and gdal follows the redirect to their region (eu-central-1)
+gdal.SetConfigOption("AWS_REQUEST_PAYER", "requester")
+
+# band of each band name used by the index expressions (see band_math), and the
+# scale that converts it to reflectance: top of atmosphere for L1C, surface
+# (bottom of atmosphere) for L2A. B11/B12 are 20 m and are resampled onto the
+# 10 m grid of B04
+reflectance_bands = {'blue': "B02.jp2", 'green': "B03.jp2", 'red': "B04.jp2", 'nir': "B08.jp2",
+                     'swir1': "B11.jp2", 'swir2': "B12.jp2"}
+reflectance_scale = 0.0001
+
+# since processing baseline 04.00, i.e. for acquisitions from 2022-01-25 on,
+# L1C and L2A bands store reflectance / reflectance_scale + 1000
+# (RADIO_ADD_OFFSET and BOA_ADD_OFFSET of -1000 in the product metadata)
+offset_baseline = (4, 0)
+offset_start_date = "20220125"
+baseline_offset = -1000
+baseline_pattern = re.compile(r"_N(?P<major>\d{2})\.?(?P<minor>\d{2})(?:_|$)")
+date_pattern = re.compile(r"_(?P<date>\d{8})T\d{6}")
+
+# cloud masks: polygons in MSK_CLOUDS_B00.gml before baseline 04.00, a 60 m
+# raster since, whose first two bands are 1 where there are opaque clouds and
+# cirrus (the third, snow, isn't used)
+cloud_mask_gml = "MSK_CLOUDS_B00.gml"
+cloud_mask_raster = "MSK_CLASSI_B00.jp2"
+cloud_mask_raster_bands = [1, 2]
+
+
+""" Process every record of an SQS batch, a few at a time (GDAL releases the GIL while reading). Failed records
+    are returned as batchItemFailures, so only those are retried (needs ReportBatchItemFailures enabled on the
+    event source mapping). """
 def lambda_handler(event, context):
-    prefix = event['Records'][0]['body']
-    prefix = prefix.split('/', 1)
+    # outputs are kept in memory, large ones fall back to the tmp directory,
+    # which is the only place we can write files (max. 512 mb)
+    os.chdir("/tmp")
+    
+    # optionally clip the output to an area of interest, e.g. /vsis3/bucket/aoi.geojson
+    aoi = load_aoi(os.environ["AOI"]) if os.environ.get("AOI") else None
+    s3 = boto3.client('s3')
+    
+    records = event['Records']
+    failures = []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(records)))) as executor:
+        futures = {executor.submit(process_record, record['body'], aoi, s3): record for record in records}
+        for future in as_completed(futures):
+            record = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Failed to process {record['body']}: {e}")
+                failures.append({'itemIdentifier': record['messageId']})
+    
+    print(f"Processed {len(records) - len(failures)}/{len(records)} records.")
+    return {'batchItemFailures': failures}
+
+
+""" Calculate NDVI for the granule in an SQS message body and upload the result. The body is either the bucket/key
+    prefix of a granule copied to our bucket, or the tile directory of a granule in a public Sentinel-2 bucket
+    (e.g. sentinel-s2-l1c/tiles/18/N/WM/2021/10/10/0), which is read in place. """
+def process_record(body, aoi, s3):
+    prefix = body.split('/', 1)
     bucket = prefix[0]
-    key = prefix[1]
+    key = prefix[1].rstrip('/')
     
-    # we can only write files to the tmp directory (max. 512 mb)
-    os.chdir("/tmp")
+    if bucket in source_buckets:
+        # only the window of the bands that covers the aoi is read from the
+        # public bucket, and only the product is written to ours
+        prefix, name = source_output(bucket, key)
+    else:
+        # remove redundant folder name from uploaded file
+        prefix, name = os.path.dirname(os.path.dirname(key)), None
     
     # vsis3 tells gdal that the file is in an s3 bucket
-    result = calc_ndvi_and_mask_s2_clouds(f"/vsis3/{bucket}/{key}")
-    print(f"Generated {result}")
+    if os.environ.get("INDICES"):
+        # several indices from one read of the bands, e.g. INDICES=ndvi,ndmi,evi
+        results = calc_indices_s2(f"/vsis3/{bucket}/{key}", os.environ["INDICES"].split(','), aoi,
+                                  separate=os.environ.get("SEPARATE_INDICES") == "1", name=name)
+    else:
+        result = calc_ndvi_and_mask_s2_clouds(f"/vsis3/{bucket}/{key}", aoi, name)
+        results = [result] if result else None
+    if not results:
+        return
     
-    # upload generated file to s3
+    # upload generated files to s3
     dest_bucket = "processed-granules"
-    # remove redundant folder name from uploaded file
-    prefix = os.path.dirname(os.path.dirname(key))
-    key = f"{prefix}/{result}"
-    s3 = boto3.client('s3')
-    s3.upload_file(result, dest_bucket, key)
-    print(f"Uploaded {key} to {dest_bucket}")
-    os.remove(result)
+    for result in results:
+        print(f"Generated {result}")
+        result_key = f"{prefix}/{os.path.basename(result)}"
+        upload_output(result, dest_bucket, result_key, s3)
+        print(f"Uploaded {result_key} to {dest_bucket}")
     
     
-""" Given a the base name of a Sentinel-2 scene, caclulate NDVI, mask clouds, and save the results as a geotiff. """
-def calc_ndvi_and_mask_s2_clouds(file):
+""" Given a the base name of a Sentinel-2 scene, caclulate NDVI, mask clouds, and save the results as a geotiff.
+    If an aoi (see load_aoi) is given, only the part of the scene that covers it is read and saved. Returns
+    None if the scene doesn't intersect the aoi. file can also be the tile directory of a public bucket (see
+    granule_file), name sets the name of the output (default: the base name of file). """
+def calc_ndvi_and_mask_s2_clouds(file, aoi=None, name=None):
     red_band = "B04.jp2"
     nir_band = "B08.jp2"
-    cloud_mask_band = "MSK_CLOUDS_B00.gml"
+    name = name or os.path.basename(file)
     
-    red_band_file = f"{file}_{red_band}"
-    nir_band_file = f"{file}_{nir_band}"
-    cloud_mask_band_file = f"{file}_{cloud_mask_band}"
+    red_band_file = granule_file(file, red_band)
+    nir_band_file = granule_file(file, nir_band)
     
     # open red and nir jp2 files
     red_ds = gdal.Open(red_band_file)
-    red = red_ds.GetRasterBand(1).ReadAsArray().astype(np.float32)
     nir_ds = gdal.Open(nir_band_file)
-    nir = nir_ds.GetRasterBand(1).ReadAsArray().astype(np.float32)
-    
-    # get extent of red band to ensure cloud_mask and ndvi will have the same extent
-    x_min, xres, xskew, y_max, yskew, yres  = red_ds.GetGeoTransform()
-    x_max = x_min + (red_ds.RasterXSize * xres)
-    y_min = y_max + (red_ds.RasterYSize * yres)
-
-    # rasterize the cloud_mask file first
-    # in theory we should be able to use the vector file to mask out clouds, but
-    # in practice gdal had complaints about the gml files. will reinvestigate this
-    # at a later date
-    cloud_mask_tif = gdal.Rasterize("mask.tif", cloud_mask_band_file, xRes=10, yRes=10, burnValues=1, 
-                                    noData=np.nan, outputType=gdal.GDT_Byte, outputBounds=[x_min, y_min, x_max, y_max])
-    if not cloud_mask_tif:
-        cloud_mask = np.zeros_like(red)
-    else:
-        cloud_mask_tif = None
-        cloud_mask_ds = gdal.Open("mask.tif")
-        cloud_mask = cloud_mask_ds.GetRasterBand(1).ReadAsArray()
-
-    ndvi_masked = mask_clouds_and_calc_ndvi(red, nir, cloud_mask)
+    
+    # only read the window of the bands that covers the aoi
+    window = (0, 0, red_ds.RasterXSize, red_ds.RasterYSize)
+    if aoi is not None:
+        window = aoi_window(red_ds, aoi)
+        if window is None:
+            print(f"{name} does not intersect the AOI. Skipping...")
+            return None
+    gt = window_geotransform(red_ds.GetGeoTransform(), window)
+    
+    # the cloud mask on the same grid as the (windowed) red band
+    cloud_mask = granule_cloud_mask(file, red_ds, gt, window)
 
-    # remove temp cloud mask file to save space
-    cloud_mask_ds = None
-    try:
-        os.remove("mask.tif")
-    except FileNotFoundError:
-        pass
+    # read and process the bands a block of rows at a time
+    ndvi_masked = mask_clouds_and_calc_ndvi_bands(red_ds.GetRasterBand(1), nir_ds.GetRasterBand(1), cloud_mask,
+                                                  window=window, offset=radiometric_offset(file))
     
-    ndvi_masked_file = f"{os.path.basename(file)}_NDVI_MASKED.TIF"
-    arr_to_gtiff(ndvi_masked, ndvi_masked_file, red_band_file)
+    ndvi_masked_file = output_path(f"{name}_NDVI_MASKED.TIF", ndvi_masked.nbytes)
+    arr_to_gtiff(ndvi_masked, ndvi_masked_file, red_band_file, xsize=window[2], ysize=window[3], gt=gt)
     
     # free data so it saves to disk properly
-    red_ds = nir_ds = cloud_mask_ds = out_ds = outband = driver = None
+    red_ds = nir_ds = out_ds = outband = driver = None
     
-    return ndvi_masked_file
\ No newline at end of file
+    return ndvi_masked_file
+
+
+""" Like calc_ndvi_and_mask_s2_clouds, but calculate several indices (names of band_math.INDICES, e.g. ['ndvi',
+    'ndmi', 'evi']) from top of atmosphere (L1C) or surface (L2A) reflectance, reading each band once. The indices
+    are saved as the bands of one geotiff, or as one geotiff each if separate. Returns the list of files, or None if
+    the scene doesn't intersect the aoi. """
+def calc_indices_s2(file, indices, aoi=None, separate=False, name=None):
+    expressions = index_expressions(indices)
+    name = name or os.path.basename(file)
+    
+    # the 10 m red band sets the output grid
+    red_band_file = granule_file(file, reflectance_bands['red'])
+    red_ds = gdal.Open(red_band_file)
+    offset = radiometric_offset(file) * reflectance_scale
+    bands = {band: (open_aligned(granule_file(file, reflectance_bands[band]), red_ds), reflectance_scale, offset)
+             for band in used_bands(expressions)}
+    
+    # only read the window of the bands that covers the aoi
+    window = (0, 0, red_ds.RasterXSize, red_ds.RasterYSize)
+    if aoi is not None:
+        window = aoi_window(red_ds, aoi)
+        if window is None:
+            print(f"{name} does not intersect the AOI. Skipping...")
+            return None
+    gt = window_geotransform(red_ds.GetGeoTransform(), window)
+    
+    cloud_mask = granule_cloud_mask(file, red_ds, gt, window)
+    outputs = calc_indices(bands, expressions, cloud_mask, window=window)
+    files = write_indices(outputs, name, red_band_file, gt, separate)
+    
+    red_ds = bands = None
+    return files
+
+
+""" Path of a file of a granule (e.g. B04.jp2): {file}_B04.jp2 for granules copied to our bucket (see
+    download_s2_imgs), or the file in the tile directory of a public bucket, where the cloud mask is in qi/ and the
+    L2A bands are in R10m/ (R20m/ for the SWIR bands). """
+def granule_file(file, name):
+    bucket = file.split('/')[2] if file.startswith("/vsis3/") else None
+    if bucket not in source_buckets:
+        return f"{file}_{name}"
+    if name.startswith("MSK_"):
+        return f"{file}/qi/{name}"
+    if bucket == "sentinel-s2-l2a":
+        return f"{file}/{'R20m' if name in ('B11.jp2', 'B12.jp2') else 'R10m'}/{name}"
+    return f"{file}/{name}"
+
+
+""" Offset (in stored values) of the bands of a granule: baseline_offset if it was processed with baseline 04.00 or
+    later (see new_baseline), otherwise 0. """
+def radiometric_offset(file):
+    return baseline_offset if new_baseline(file) else 0
+
+
+""" Whether a granule was processed with baseline 04.00 or later, which offsets the bands (see radiometric_offset)
+    and replaced the cloud mask (see granule_cloud_mask). The baseline is in the tile id that names granules copied
+    to our bucket (e.g. ..._T18NWM_N04.00_0). Otherwise the date decides: the acquisition date of tiles in a public
+    bucket, which hold the original processing of each acquisition, or the processing date in the tile id. """
+def new_baseline(file):
+    m = baseline_pattern.search(os.path.basename(file))
+    if m is not None:
+        return (int(m.group('major')), int(m.group('minor'))) >= offset_baseline
+
+    m = source_tile_pattern.search(file)
+    if m is not None:
+        date = f"{m.group('year')}{m.group('month').zfill(2)}{m.group('day').zfill(2)}"
+    else:
+        m = date_pattern.search(os.path.basename(file))
+        if m is None:
+            raise ValueError(f"can't tell the processing baseline of {file}")
+        date = m.group('date')
+    return date >= offset_start_date
+
+
+""" Cloud mask of a granule on the grid of the (windowed) 10 m band ref_ds, in a form calc_indices and
+    mask_clouds_and_calc_ndvi_bands take: for baseline 04.00 or later, a function reading the opaque cloud and
+    cirrus bands of MSK_CLASSI_B00.jp2 (resampled to 10 m) a block at a time; before, the rasterized polygons of
+    MSK_CLOUDS_B00.gml, or None if there are none. Raises RuntimeError if the raster mask can't be read, rather
+    than writing unmasked outputs. """
+def granule_cloud_mask(file, ref_ds, gt, window):
+    if not new_baseline(file):
+        return rasterize_cloud_mask(granule_file(file, cloud_mask_gml), gt, ref_ds.GetProjection(),
+                                    window[2], window[3])
+
+    mask_ds = open_aligned(granule_file(file, cloud_mask_raster), ref_ds)
+
+    def cloud_mask(xoff, yoff, xsize, ysize):
+        mask = None
+        for band in cloud_mask_raster_bands:
+            arr = mask_ds.GetRasterBand(band).ReadAsArray(xoff, yoff, xsize, ysize)
+            mask = arr if mask is None else mask | arr
+        return mask
+    return cloud_mask
+
+
+""" Output prefix and name of a tile in a public bucket, laid out like the granules copied by download_s2_imgs, e.g.
+    tiles/18/N/WM/2021/10/10/0 -> (s2-l1c/18/N/WM/2021/10, T18NWM_20211010_0). """
+def source_output(bucket, key):
+    m = source_tile_pattern.search(key)
+    if m is None:
+        raise ValueError(f"not a Sentinel-2 tile directory: {bucket}/{key}")
+    month = m.group('month').zfill(2)
+    day = m.group('day').zfill(2)
+    prefix = f"{source_buckets[bucket]}/{m.group('utm')}/{m.group('lat')}/{m.group('square')}/{m.group('year')}/{month}"
+    name = f"T{m.group('utm').zfill(2)}{m.group('lat')}{m.group('square')}_{m.group('year')}{month}{day}_{m.group('sequence')}"
+    return prefix, name
+
+
+""" Load the cloud polygons of a MSK_CLOUDS_B00.gml file into an in-memory vector dataset. Returns None if the
+    file doesn't exist or has no polygons (cloud free). Raises RuntimeError if the file exists but can't be read
+    (or we can't tell whether it exists, e.g. access denied), so the record fails and is retried instead of being
+    processed without its clouds. Masks are cached per file, including the ones that are None. """
+def load_cloud_mask(file):
+    with cloud_masks_lock:
+        if file in cloud_masks:
+            return cloud_masks[file]
+
+    mask_ds = None
+    gml_ds = ogr.Open(file)
+    if gml_ds is None:
+        error = gdal.GetLastErrorMsg()
+        gdal.VSIErrorReset()
+        if gdal.VSIStatL(file) is not None or gdal.VSIGetLastErrorNo() not in (0, vsi_object_not_found):
+            raise RuntimeError(f"Can't read cloud mask {file}: {gdal.VSIGetLastErrorMsg() or error}")
+        print(f"WARNING: {file} doesn't exist, processing without a cloud mask")
+    elif gml_ds.GetLayerCount() > 0 and gml_ds.GetLayer(0).GetFeatureCount() > 0:
+        mask_ds = ogr.GetDriverByName("Memory").CreateDataSource("")
+        mask_ds.CopyLayer(gml_ds.GetLayer(0), "clouds")
+    gml_ds = None
+
+    with cloud_masks_lock:
+        if len(cloud_masks) >= max_cloud_masks:
+            cloud_masks.pop(next(iter(cloud_masks)))
+        cloud_masks[file] = mask_ds
+    return mask_ds
+
+
+""" Rasterize the cloud mask of a MSK_CLOUDS_B00.gml file onto a grid, in memory. Returns a uint8 array that is 1
+    where cloudy, or None if there are no clouds on the grid. """
+def rasterize_cloud_mask(file, gt, proj, xsize, ysize):
+    mask_ds = load_cloud_mask(file)
+    if mask_ds is None:
+        return None
+
+    target_ds = gdal.GetDriverByName("MEM").Create("", xsize, ysize, 1, gdal.GDT_Byte)
+    target_ds.SetGeoTransform(gt)
+    target_ds.SetProjection(proj)
+    # cached masks are shared between threads, and reading a layer isn't thread safe
+    with cloud_masks_lock:
+        gdal.RasterizeLayer(target_ds, [1], mask_ds.GetLayer(0), burn_values=[1])
+    cloud_mask = target_ds.GetRasterBand(1).ReadAsArray()
+    target_ds = None
+
+    return cloud_mask if cloud_mask.any() else None
\ No newline at end of file
@@ -0,0 +1,112 @@
+import numpy as np
+
+
+""" Windowed count, mean and variance of a band, backed by summed-area tables.
+
+    The tables are built once per band (in float64, on values shifted by the
+    band mean to avoid cancellation in E[X^2] - (E[X])^2), after which the
+    statistics for any odd window size cost O(1) per pixel. NaN and nodata
+    pixels are excluded from all statistics.
+
+    Windows can be evaluated in two edge modes:
+      'constant': windows are clipped at the image edges, like the
+                  BORDER_ISOLATED box filters in enhanced_lee
+      'nearest':  edge pixels are repeated, like generic_filter(mode='nearest').
+                  The band has to be built with pad >= win_size // 2 for this. """
+class WindowStats:
+    def __init__(self, img, nodata=None, pad=0):
+        img = img.astype(np.float64)
+        self.shape = img.shape
+        self.pad = pad
+
+        # Get image mask (True: nodata)
+        invalid = np.isnan(img)
+        if nodata is not None and not np.isnan(nodata):
+            invalid |= img == nodata
+
+        # Shift values by the band mean before accumulating
+        img[invalid] = np.nan
+        self.offset = np.nanmean(img) if not np.all(invalid) else 0.0
+        img -= self.offset
+        img[invalid] = 0
+        valid = np.logical_not(invalid)
+
+        # Repeat edge pixels so 'nearest' windows can reach past the image edges
+        if pad:
+            img = np.pad(img, pad, mode='edge')
+            valid = np.pad(valid, pad, mode='edge')
+
+        self.count_table = self._summed_area_table(valid, np.int64)
+        self.sum_table = self._summed_area_table(img, np.float64)
+        self.sum2_table = self._summed_area_table(np.square(img, out=img), np.float64)
+
+    """ Summed-area table of arr, with a leading row and column of zeros. """
+    @staticmethod
+    def _summed_area_table(arr, dtype):
+        table = np.zeros((arr.shape[0] + 1, arr.shape[1] + 1), dtype=dtype)
+        np.cumsum(arr, axis=0, dtype=dtype, out=table[1:, 1:])
+        np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+        return table
+
+    """ Start/end indices into the tables for every row or column of the image. """
+    def _bounds(self, size, win_size, mode):
+        if win_size % 2 == 0:
+            raise ValueError(f"window size must be odd: {win_size}")
+
+        half = win_size // 2
+        idx = np.arange(size) + self.pad
+        if mode == 'constant':
+            lo, hi = self.pad, self.pad + size
+        elif mode == 'nearest':
+            if half > self.pad:
+                raise ValueError(f"window size {win_size} needs pad >= {half} for mode 'nearest'")
+            lo, hi = 0, size + 2 * self.pad
+        else:
+            raise ValueError(f"unsupported mode: {mode}")
+
+        return np.clip(idx - half, lo, hi), np.clip(idx + half + 1, lo, hi)
+
+    """ Sum of a summed-area table over every window. """
+    def _window_sum(self, table, win_size, mode):
+        r0, r1 = self._bounds(self.shape[0], win_size, mode)
+        c0, c1 = self._bounds(self.shape[1], win_size, mode)
+
+        # difference along rows first, then along columns
+        rows = table.take(r1, axis=0)
+        rows -= table.take(r0, axis=0)
+        total = rows.take(c1, axis=1)
+        total -= rows.take(c0, axis=1)
+        return total
+
+    """ Number of valid pixels, mean and population variance within each window,
+        computed together since they share the same sums. Mean and variance
+        are NaN for windows without any valid pixels. """
+    def window_stats(self, win_size, mode='constant'):
+        pix_num = self._window_sum(self.count_table, win_size, mode)
+        idx = pix_num != 0      # Avoid division by zero
+
+        img_mean = np.full(self.shape, np.nan)
+        img_var = np.full(self.shape, np.nan)
+        np.divide(self._window_sum(self.sum_table, win_size, mode), pix_num, out=img_mean, where=idx)
+        np.divide(self._window_sum(self.sum2_table, win_size, mode), pix_num, out=img_var, where=idx)
+
+        img_var -= np.square(img_mean)
+        np.maximum(img_var, 0, out=img_var)
+        img_mean += self.offset
+        return pix_num, img_mean, img_var
+
+    """ Number of valid pixels within each window. """
+    def count(self, win_size, mode='constant'):
+        return self._window_sum(self.count_table, win_size, mode)
+
+    """ Mean of the valid pixels within each window. """
+    def mean(self, win_size, mode='constant'):
+        return self.window_stats(win_size, mode)[1]
+
+    """ Population variance of the valid pixels within each window. """
+    def variance(self, win_size, mode='constant'):
+        return self.window_stats(win_size, mode)[2]
+
+    """ Population standard deviation of the valid pixels within each window. """
+    def std(self, win_size, mode='constant'):
+        return np.sqrt(self.variance(win_size, mode))
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# the scripts import their siblings by name, so put their directories on the path
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ("processing", "util", "classification"):
+    sys.path.insert(0, os.path.join(root, folder))
+
+# s1_batch creates an s3 client on import
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
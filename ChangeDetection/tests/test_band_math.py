@@ -0,0 +1,19 @@
+import pytest
+
+from band_math import INDICES, index_product
+from batch_driver import product_of
+
+
+@pytest.mark.parametrize("name", list(INDICES))
+def test_index_outputs_differ_from_ndvi_outputs(name):
+    # the NDVI path computes NDVI from stored values, calc_indices from
+    # reflectance, so their outputs must never be taken for one another
+    # (e.g. by make_csv, which matches keys by substring)
+    assert product_of() == "NDVI_MASKED"
+    for product in (product_of([name], separate=True), product_of([name, "ndvi"])):
+        assert "NDVI_MASKED" not in product
+
+
+def test_product_of_matches_write_indices():
+    assert product_of(["ndmi", "ndvi"], separate=True) == index_product("ndmi") == "IDX_NDMI"
+    assert product_of(["ndmi", "ndvi"]) == index_product() == "INDICES_MASKED"
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from s1_batch import enhanced_lee, enhanced_lee_f32, halo_windows, moving_std
+
+
+# enhanced_lee_f32 computes the window variance in float32, so it can differ from
+# enhanced_lee by ~1e-3 (relative) where the weights are sensitive to it
+RTOL = 2e-3
+ATOL = 1e-6
+
+
+""" Gamma0-like speckle (3 looks) over a varying backscatter, with 5% NaN
+    pixels and a NaN corner. """
+def speckle(shape=(300, 257), seed=0):
+    rng = np.random.default_rng(seed)
+    img = rng.gamma(3, 1 / 3, shape) * rng.uniform(0.01, 0.5, shape)
+    img[rng.random(shape) < 0.05] = np.nan
+    img[:20, :40] = np.nan
+    return img.astype(np.float32)
+
+
+""" Filter img block by block with halo_windows, like s1_batch.filter_granule. """
+def filter_blocks(img, func, block_size, halo):
+    out = np.full(img.shape, -1, dtype=np.float32)
+    for read_win, write_win, interior in halo_windows(img.shape[1], img.shape[0], block_size, halo):
+        block = img[read_win.row_off:read_win.row_off + read_win.height,
+                    read_win.col_off:read_win.col_off + read_win.width]
+        out[write_win.row_off:write_win.row_off + write_win.height,
+            write_win.col_off:write_win.col_off + write_win.width] = func(block)[interior]
+    return out
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_enhanced_lee_f32_matches_reference(seed):
+    img = speckle(seed=seed)
+    expected = enhanced_lee(img, 5, 3, nodata=np.nan)
+    actual = enhanced_lee_f32(img, 5, 3, nodata=np.nan)
+
+    assert actual.dtype == np.float32
+    np.testing.assert_array_equal(np.isnan(actual), np.isnan(expected))
+    valid = ~np.isnan(expected)
+    np.testing.assert_allclose(actual[valid], expected[valid], rtol=RTOL, atol=ATOL)
+
+
+def test_enhanced_lee_f32_reuses_out():
+    img = speckle()
+    out = np.empty(img.shape, dtype=np.float32)
+    result = enhanced_lee_f32(img, 5, 3, nodata=np.nan, out=out)
+    assert result is out
+
+
+@pytest.mark.parametrize("func, win_size", [
+    (lambda img: enhanced_lee_f32(img, 5, 3, nodata=np.nan), 5),
+    (lambda img: enhanced_lee(img, 5, 3, nodata=np.nan), 5),
+    (lambda img: moving_std(img, 7, nodata=np.nan), 7),
+])
+@pytest.mark.parametrize("block_size", [64, 100, 300])
+def test_blocks_match_full_array(func, win_size, block_size):
+    img = speckle()
+    expected = func(img)
+    actual = filter_blocks(img, func, block_size, win_size // 2)
+    np.testing.assert_array_equal(actual, expected)
+
+
+def test_halo_windows_cover_raster_once():
+    covered = np.zeros((300, 257), dtype=int)
+    for read_win, write_win, interior in halo_windows(257, 300, 64, 2):
+        covered[write_win.row_off:write_win.row_off + write_win.height,
+                write_win.col_off:write_win.col_off + write_win.width] += 1
+        assert interior[0].stop - interior[0].start == write_win.height
+        assert interior[1].stop - interior[1].start == write_win.width
+        assert read_win.row_off >= 0 and read_win.row_off + read_win.height <= 300
+        assert read_win.col_off >= 0 and read_win.col_off + read_win.width <= 257
+    assert (covered == 1).all()
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from sklearn.naive_bayes import GaussianNB
+
+from gnb_kernel import GaussianNBKernel, check_parity, fast_model
+
+
+""" Two-class GaussianNB fit on synthetic VV/VH-like (dB) samples, plus a
+    separate set of samples to predict. """
+@pytest.fixture(scope="module")
+def fitted():
+    rng = np.random.default_rng(0)
+    n = 2000
+    X = np.concatenate([rng.normal([-8, -14], [1.5, 2.0], size=(n, 2)),
+                        rng.normal([-12, -19], [2.5, 1.5], size=(n, 2))]).astype(np.float32)
+    y = np.repeat([0, 1], n)
+    model = GaussianNB().fit(X, y)
+    X_test = rng.uniform([-20, -28], [0, -6], size=(10000, 2)).astype(np.float32)
+    return model, X_test
+
+
+def test_fast_model_is_kernel(fitted):
+    model, _ = fitted
+    assert isinstance(fast_model(model), GaussianNBKernel)
+
+
+def test_predict_matches_model(fitted):
+    model, X = fitted
+    kernel = GaussianNBKernel(model)
+    np.testing.assert_array_equal(kernel.predict(X), model.predict(X))
+    assert check_parity(model, n=100_000) <= 1e-4
+
+
+def test_predict_proba_matches_model(fitted):
+    model, X = fitted
+    np.testing.assert_allclose(GaussianNBKernel(model).predict_proba(X), model.predict_proba(X), atol=1e-5)
+
+
+def test_nan_rows(fitted):
+    model, X = fitted
+    X = X[:100].copy()
+    X[::10, 0] = np.nan
+    X[5::10, 1] = np.nan
+    nan_rows = np.isnan(X).any(axis=1)
+    kernel = GaussianNBKernel(model)
+
+    # sklearn rejects NaN, so the other rows are compared on their own
+    proba = kernel.predict_proba(X)
+    assert np.isnan(proba[nan_rows]).all()
+    np.testing.assert_allclose(proba[~nan_rows], model.predict_proba(X[~nan_rows]), atol=1e-5)
+
+    predicted = kernel.predict(X)
+    assert (predicted[nan_rows] == model.classes_[0]).all()
+    np.testing.assert_array_equal(predicted[~nan_rows], model.predict(X[~nan_rows]))
@@ -0,0 +1,68 @@
+import fcntl
+import os
+import threading
+
+from granule_cache import GranuleCache
+
+
+""" Just enough of an s3 client for GranuleCache: objects are bytes in a dict. """
+class FakeS3:
+    def __init__(self, objects):
+        self.objects = objects
+        self.downloads = 0
+
+    def head_object(self, Bucket, Key):
+        return {'ETag': f'"{len(self.objects[Key])}"'}
+
+    def download_file(self, bucket, key, filename):
+        self.downloads += 1
+        with open(filename, 'wb') as file:
+            file.write(self.objects[key])
+
+
+def make_cache(tmp_path, max_bytes=250):
+    s3 = FakeS3({f"g{i}.zip": bytes(100) for i in range(4)})
+    return GranuleCache(tmp_path, max_bytes, s3), s3
+
+
+def test_get_downloads_once(tmp_path):
+    cache, s3 = make_cache(tmp_path)
+    with cache.local_copy("bucket", "g0.zip") as path:
+        assert os.path.getsize(path) == 100
+    with cache.local_copy("bucket", "g0.zip"):
+        pass
+    assert s3.downloads == 1
+    assert cache.stats() == {'hits': 1, 'misses': 1}
+
+
+def test_evict_removes_lock_files_but_not_objects_in_use(tmp_path):
+    cache, _ = make_cache(tmp_path)
+    in_use = cache.get("bucket", "g0.zip")
+    for key in ("g1.zip", "g2.zip", "g3.zip"):
+        with cache.local_copy("bucket", key):
+            pass
+
+    assert os.path.exists(in_use)
+    cached = sorted(name for name in os.listdir(tmp_path / "bucket") if name.endswith(".zip"))
+    assert cached == ["g0.zip", "g3.zip"]
+    assert not os.path.exists(tmp_path / "bucket" / "g1.zip.lock")
+    assert not os.path.exists(tmp_path / "bucket" / "g2.zip.lock")
+    cache.release(in_use)
+
+
+def test_lock_follows_removed_lock_file(tmp_path):
+    path = str(tmp_path / "g0.zip")
+    first = GranuleCache._lock_object(path)
+    locked = []
+    waiter = threading.Thread(target=lambda: locked.append(GranuleCache._lock_object(path)))
+    waiter.start()
+
+    # evict() removes the lock file while holding it, then releases it
+    os.remove(f"{path}.lock")
+    fcntl.flock(first, fcntl.LOCK_UN)
+    first.close()
+    waiter.join(5)
+
+    assert locked
+    assert os.path.samestat(os.fstat(locked[0].fileno()), os.stat(f"{path}.lock"))
+    locked[0].close()
@@ -0,0 +1,135 @@
+from concurrent.futures import ProcessPoolExecutor
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+import functools
+import multiprocessing
+import os
+import threading
+import zipfile
+
+import numpy as np
+import pytest
+import rasterio
+
+from s1_batch import GRANULE_ENV, read_bands
+
+
+BASENAME = "S1A_IW_20211010T230104_DVP_RTC30_G_gpuned_5C3D"
+BANDS = ["VV", "VH", "inc_map"]
+
+
+""" Serves the files of a directory with Range support (enough for /vsicurl)
+    and counts the requests. """
+class RangeHandler(SimpleHTTPRequestHandler):
+    requests = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+        RangeHandler.requests.append((self.command, self.headers.get("Range")))
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        if self.headers.get("Range"):
+            first, last = self.headers["Range"].split("=")[1].split("-")
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        f = open(path, 'rb')
+        f.seek(start)
+        return RangeFile(f, end - start + 1)
+
+    def copyfile(self, source, outputfile):
+        outputfile.write(source.read())
+        source.close()
+
+
+class RangeFile:
+    def __init__(self, f, length):
+        self.f = f
+        self.length = length
+
+    def read(self):
+        return self.f.read(self.length)
+
+    def close(self):
+        self.f.close()
+
+
+""" A small HyP3 RTC zip: {BASENAME}/{BASENAME}_{band}.tif for VV, VH and INC_MAP. """
+@pytest.fixture(scope="module")
+def granule_dir(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("granules")
+    rng = np.random.default_rng(0)
+    profile = dict(driver="GTiff", width=512, height=512, count=1, dtype="float32", nodata=0,
+                   crs="EPSG:32618", transform=rasterio.transform.from_origin(500000, 100000, 30, 30))
+    with zipfile.ZipFile(folder / f"{BASENAME}.zip", 'w', zipfile.ZIP_DEFLATED) as archive:
+        for band in BANDS:
+            tif = folder / f"{BASENAME}_{band}.tif"
+            with rasterio.open(tif, 'w', **profile) as dst:
+                dst.write(rng.gamma(3, 0.05, (1, 512, 512)).astype(np.float32))
+            archive.write(tif, f"{BASENAME}/{BASENAME}_{band}.tif")
+    return folder
+
+
+@pytest.fixture(scope="module")
+def server(granule_dir):
+    handler = functools.partial(RangeHandler, directory=str(granule_dir))
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+
+
+""" Read the bands of the zip at url like the per-band path before
+    filter_granule: each band opened in its own environment, then its mask. """
+def read_per_band(url):
+    arrs = []
+    for band in BANDS:
+        with rasterio.Env(), rasterio.open(f"/vsizip//vsicurl/{url}/{BASENAME}.zip/{BASENAME}/{BASENAME}_{band}.tif") as src:
+            arrs.append(src.read(1))
+            src.read_masks(1)
+    return arrs
+
+
+""" Read the bands of the zip at url like filter_granule. """
+def read_granule(url):
+    with rasterio.Env(**GRANULE_ENV):
+        srcs = [rasterio.open(f"/vsizip//vsicurl/{url}/{BASENAME}.zip/{BASENAME}/{BASENAME}_{band}.tif") for band in BANDS]
+        try:
+            stack, _ = read_bands(srcs)
+        finally:
+            for src in srcs:
+                src.close()
+    return stack
+
+
+""" Number of requests func(url) makes, and its result. func runs in a new
+    process, since gdal keeps some curl settings (e.g. the chunk size) and its
+    cache for the rest of the process. """
+def count_requests(func, url):
+    RangeHandler.requests = []
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        result = executor.submit(func, url).result()
+    return len(RangeHandler.requests), result
+
+
+def test_granule_env_reads_less(server):
+    per_band, expected = count_requests(read_per_band, server)
+    single_pass, stack = count_requests(read_granule, server)
+
+    assert single_pass * 2 <= per_band, (single_pass, per_band)
+    for band, arr in zip(stack, expected):
+        np.testing.assert_array_equal(band, np.where(arr == 0, np.nan, arr))
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+import s2_lambda
+from s2_lambda import granule_cloud_mask, radiometric_offset
+
+
+# tiles of a public bucket and granules copied to ours, either side of the
+# switch to processing baseline 04.00 (MSK_CLASSI_B00.jp2 instead of
+# MSK_CLOUDS_B00.gml) on 2022-01-25
+OLD_BASELINE = ["/vsis3/sentinel-s2-l2a/tiles/18/N/WM/2022/1/24/0",
+                "/vsis3/raw-granules/s2/T18NWM_20211010_0/S2A_MSIL2A_20211010T152641_N03.01_R025_T18NWM_0"]
+NEW_BASELINE = ["/vsis3/sentinel-s2-l2a/tiles/18/N/WM/2022/1/25/0",
+                "/vsis3/raw-granules/s2/T18NWM_20220210_0/S2A_MSIL2A_20220210T152641_N04.00_R025_T18NWM_0"]
+
+WINDOW = (100, 200, 4, 3)
+
+
+class FakeBand:
+    def __init__(self, arr):
+        self.arr = arr
+
+    def ReadAsArray(self, xoff, yoff, xsize, ysize):
+        return self.arr[yoff:yoff + ysize, xoff:xoff + xsize]
+
+
+class FakeDataset:
+    def __init__(self, *arrs):
+        self.bands = [FakeBand(arr) for arr in arrs]
+
+    def GetRasterBand(self, band):
+        return self.bands[band - 1]
+
+    def GetProjection(self):
+        return "EPSG:32618"
+
+
+@pytest.fixture
+def masks(monkeypatch):
+    opened = []
+    rasterized = []
+    shape = (WINDOW[1] + WINDOW[3], WINDOW[0] + WINDOW[2])
+    opaque, cirrus, snow = np.zeros(shape, np.uint8), np.zeros(shape, np.uint8), np.ones(shape, np.uint8)
+    opaque[200, 100] = cirrus[201, 101] = 1
+
+    def open_aligned(file, ref_ds):
+        opened.append(file)
+        return FakeDataset(opaque, cirrus, snow)
+
+    def rasterize_cloud_mask(file, gt, proj, xsize, ysize):
+        rasterized.append(file)
+        return np.zeros((ysize, xsize), np.uint8)
+
+    monkeypatch.setattr(s2_lambda, "open_aligned", open_aligned)
+    monkeypatch.setattr(s2_lambda, "rasterize_cloud_mask", rasterize_cloud_mask)
+    return opened, rasterized
+
+
+@pytest.mark.parametrize("file", OLD_BASELINE)
+def test_old_baseline_rasterizes_gml(masks, file):
+    opened, rasterized = masks
+    mask = granule_cloud_mask(file, FakeDataset(), None, WINDOW)
+
+    assert rasterized == [s2_lambda.granule_file(file, "MSK_CLOUDS_B00.gml")]
+    assert opened == []
+    assert mask.shape == (WINDOW[3], WINDOW[2])
+    assert radiometric_offset(file) == 0
+
+
+@pytest.mark.parametrize("file", NEW_BASELINE)
+def test_new_baseline_reads_opaque_and_cirrus(masks, file):
+    opened, rasterized = masks
+    mask = granule_cloud_mask(file, FakeDataset(), None, WINDOW)
+
+    assert opened == [s2_lambda.granule_file(file, "MSK_CLASSI_B00.jp2")]
+    assert rasterized == []
+    # read a block at a time at the absolute offsets of the bands, and only
+    # opaque clouds and cirrus count (not snow)
+    expected = np.zeros((2, 4), np.uint8)
+    expected[0, 0] = expected[1, 1] = 1
+    np.testing.assert_array_equal(mask(100, 200, 4, 2), expected)
+    assert radiometric_offset(file) == s2_lambda.baseline_offset
+
+
+def test_missing_raster_mask_fails(monkeypatch):
+    def open_aligned(file, ref_ds):
+        raise RuntimeError(f"Can't open {file}")
+
+    monkeypatch.setattr(s2_lambda, "open_aligned", open_aligned)
+    with pytest.raises(RuntimeError):
+        granule_cloud_mask(NEW_BASELINE[0], FakeDataset(), None, WINDOW)
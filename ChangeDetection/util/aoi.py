@@ -0,0 +1,59 @@
+import math
+
+from osgeo import ogr
+from osgeo import osr
+
+
+# load the union of the polygons in a vector file (e.g. polygons/aoi_1.geojson)
+def load_aoi(file):
+    ds = ogr.Open(file)
+    if ds is None:
+        raise FileNotFoundError(file)
+    layer = ds.GetLayer()
+
+    aoi = None
+    for feature in layer:
+        geom = feature.GetGeometryRef()
+        aoi = geom.Clone() if aoi is None else aoi.Union(geom)
+    if aoi is None:
+        raise ValueError(f"no features in {file}")
+
+    srs = layer.GetSpatialRef()
+    if srs is None:
+        # GeoJSON without a crs member is WGS84
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(4326)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    aoi.AssignSpatialReference(srs)
+    return aoi
+
+
+# get the pixel window (xoff, yoff, xsize, ysize) of a dataset that covers an
+# aoi (see load_aoi), or None if they don't intersect
+def aoi_window(ds, aoi):
+    # reproject the aoi to the dataset's crs
+    ds_srs = osr.SpatialReference()
+    ds_srs.ImportFromWkt(ds.GetProjection())
+    ds_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    aoi = aoi.Clone()
+    aoi.TransformTo(ds_srs)
+    min_x, max_x, min_y, max_y = aoi.GetEnvelope()
+
+    # envelope in pixel coordinates (rows go down, so yres is negative)
+    x0, xres, _, y0, _, yres = ds.GetGeoTransform()
+    col_start = max(math.floor((min_x - x0) / xres), 0)
+    col_end = min(math.ceil((max_x - x0) / xres), ds.RasterXSize)
+    row_start = max(math.floor((max_y - y0) / yres), 0)
+    row_end = min(math.ceil((min_y - y0) / yres), ds.RasterYSize)
+
+    if col_end <= col_start or row_end <= row_start:
+        return None
+    return col_start, row_start, col_end - col_start, row_end - row_start
+
+
+# get the geotransform of a window of a dataset
+def window_geotransform(gt, window):
+    xoff, yoff, _, _ = window
+    x0, xres, xskew, y0, yskew, yres = gt
+    return (x0 + xoff * xres + yoff * xskew, xres, xskew,
+            y0 + xoff * yskew + yoff * yres, yskew, yres)
@@ -1,33 +1,111 @@
-from osgeo import gdal
+from osgeo import gdal, gdal_array
 import numpy as np
 
 
+""" Creation options for Cloud-Optimized GeoTIFF outputs: internal 512x512
+    tiles, DEFLATE (or ZSTD) compression with a predictor suited to the data
+    type (floating point for float bands), and overviews. Overviews of
+    categorical bands (e.g. forest masks) use nearest neighbour resampling. """
+def cog_options(dtype=gdal.GDT_Float32, compress="DEFLATE", categorical=False):
+    return [
+        f"COMPRESS={compress}",
+        "PREDICTOR=YES",    # floating point predictor for float bands, horizontal otherwise
+        "BLOCKSIZE=512",
+        "OVERVIEWS=AUTO",
+        f"RESAMPLING={'NEAREST' if categorical or not is_float(dtype) else 'AVERAGE'}",
+        "BIGTIFF=IF_SAFER",
+        "NUM_THREADS=ALL_CPUS",
+    ]
+
+
+def is_float(dtype):
+    return dtype in (gdal.GDT_Float32, gdal.GDT_Float64)
+
+
+""" Convert an existing raster (e.g. a GeoTIFF written block by block) to a
+    Cloud-Optimized GeoTIFF. """
+def gtiff_to_cog(src, out_name, compress="DEFLATE", categorical=False):
+    src_ds = gdal.Open(src)
+    dtype = src_ds.GetRasterBand(1).DataType
+    gdal.GetDriverByName("COG").CreateCopy(out_name, src_ds,
+                                           options=cog_options(dtype, compress, categorical))
+    src_ds = None
+
+
 """ Given a numpy array and an output name, save the array as a geotiff using
-    base_tif to set the geotransform and projection of the new geotiff. """
-def arr_to_gtiff(arr, out_name, base_tif, dtype=gdal.GDT_Float32, xsize=None, ysize=None):
+    base_tif to set the geotransform and projection of the new geotiff. The
+    output is a Cloud-Optimized GeoTIFF unless cog is False. Pass gt (and
+    xsize/ysize) to override the geotransform, e.g. for a window of base_tif. """
+def arr_to_gtiff(arr, out_name, base_tif, dtype=gdal.GDT_Float32, xsize=None, ysize=None,
+                 cog=True, compress="DEFLATE", gt=None):
     base_ds = gdal.Open(base_tif)
 
     # get geotransform, projection, and size from the base geotiff
-    gt = base_ds.GetGeoTransform()
+    if gt is None:
+        gt = base_ds.GetGeoTransform()
     proj = base_ds.GetProjection()
     if not xsize:
         xsize = base_ds.RasterXSize
         ysize = base_ds.RasterYSize
 
-    # write the array to a new file
-    driver = gdal.GetDriverByName("GTiff")
+    # write the array to a new file. the COG driver can't write arrays directly,
+    # so build the raster in memory first and copy it
+    driver = gdal.GetDriverByName("MEM" if cog else "GTiff")
     driver.Register()
-    out_ds = driver.Create(out_name,
-                          xsize = xsize,
-                          ysize = ysize,
-                          bands = 1,
-                          eType = dtype)
+    if cog and arr.shape == (ysize, xsize) and gdal_array.NumericTypeCodeToGDALTypeCode(arr.dtype) == dtype:
+        # wrap the array itself instead of copying it
+        out_ds = gdal_array.OpenArray(arr)
+        outband = out_ds.GetRasterBand(1)
+    else:
+        out_ds = driver.Create("" if cog else out_name,
+                              xsize = xsize,
+                              ysize = ysize,
+                              bands = 1,
+                              eType = dtype)
+        outband = out_ds.GetRasterBand(1)
+        outband.WriteArray(arr)
     out_ds.SetGeoTransform(gt)
     out_ds.SetProjection(proj)
-    outband = out_ds.GetRasterBand(1)
-    outband.WriteArray(arr)
     outband.SetNoDataValue(np.nan)
-    outband.FlushCache
-    
+    outband.FlushCache()
+
+    if cog:
+        # integer outputs are class masks/counts, so don't average their overviews
+        gdal.GetDriverByName("COG").CreateCopy(out_name, out_ds,
+                                               options=cog_options(dtype, compress, categorical=not is_float(dtype)))
+
     # free data so it saves to disk properly
     base_ds = out_ds = outband = driver = None
+
+
+""" Save several float32 arrays of the same shape as the bands of one geotiff
+    (see arr_to_gtiff), e.g. the indices from band_math.calc_indices. names
+    sets the band descriptions. """
+def arrs_to_gtiff(arrs, out_name, base_tif, names=None, xsize=None, ysize=None,
+                  cog=True, compress="DEFLATE", gt=None):
+    base_ds = gdal.Open(base_tif)
+
+    if gt is None:
+        gt = base_ds.GetGeoTransform()
+    proj = base_ds.GetProjection()
+    if not xsize:
+        xsize = base_ds.RasterXSize
+        ysize = base_ds.RasterYSize
+
+    driver = gdal.GetDriverByName("MEM" if cog else "GTiff")
+    out_ds = driver.Create("" if cog else out_name, xsize, ysize, len(arrs), gdal.GDT_Float32,
+                           options=[] if cog else ["INTERLEAVE=BAND"])
+    out_ds.SetGeoTransform(gt)
+    out_ds.SetProjection(proj)
+    for i, arr in enumerate(arrs):
+        outband = out_ds.GetRasterBand(i + 1)
+        outband.WriteArray(arr)
+        outband.SetNoDataValue(np.nan)
+        if names:
+            outband.SetDescription(names[i])
+    out_ds.FlushCache()
+
+    if cog:
+        gdal.GetDriverByName("COG").CreateCopy(out_name, out_ds, options=cog_options(gdal.GDT_Float32, compress))
+
+    base_ds = out_ds = outband = driver = None
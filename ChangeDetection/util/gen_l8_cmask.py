@@ -1,10 +1,11 @@
 import argparse
+import sys
 
 from osgeo import gdal
-import numpy as np
 
 sys.path.insert(0, "../util/")
 from arr_to_gtiff import arr_to_gtiff
+from landsat_qa import QA_BITS, decode_qa
 
 
 def main():
@@ -13,19 +14,16 @@ def main():
     
     parser.add_argument("qa_file", type=str,
                         help="location of the qa_pixel file")
+    parser.add_argument("--flags", nargs="+", choices=list(QA_BITS),
+                        default=['dilated_cloud', 'cirrus', 'cloud', 'cloud_shadow'],
+                        help="QA flags to include in the mask (default: dilated_cloud cirrus cloud cloud_shadow)")
     args = parser.parse_args()
 
     qa_ds = gdal.Open(args.qa_file)
     qa = qa_ds.GetRasterBand(1).ReadAsArray()
     
-    # calculate cloud mask
-    # bits 3 and 4 are cloud and cloud shadow, respectively
-    dilated_cloud_bit = 1 << 1
-    cirrus_bit = 1 << 2
-    cloud_bit = 1 << 3
-    cloud_shadow_bit = 1 << 4
-    bit_mask = dilated_cloud_bit | cirrus_bit | cloud_bit | cloud_shadow_bit
-    cloud_mask = ((np.bitwise_and(qa, bit_mask) != 0) * 1).astype(np.int16)
+    # calculate cloud mask, 1 where any of the flags is set
+    cloud_mask = decode_qa(qa, args.flags)
 
     arr_to_gtiff(cloud_mask, "cloud_mask.tif", args.qa_file)
 
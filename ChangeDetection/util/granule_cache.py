@@ -0,0 +1,155 @@
+import fcntl
+import os
+import tempfile
+from contextlib import contextmanager
+
+import boto3
+
+
+""" On-disk cache of raw granules from s3, so re-runs read a local copy instead
+    of going through /vsis3 again.
+
+    Objects are stored under cache_dir/bucket/key, next to a .etag file with the
+    ETag they were downloaded with, so a changed object is fetched again. When
+    the cache grows past max_bytes the least recently used objects are removed.
+    Several processes on one host can share a cache directory: downloads and
+    evictions are serialized with file locks, and objects that are in use (see
+    get/release and local_copy) are never evicted. """
+class GranuleCache:
+    def __init__(self, cache_dir, max_bytes, s3=None):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.s3 = s3 or boto3.client('s3')
+        self.hits = 0
+        self.misses = 0
+        self.held = {}      # local path -> open lock file, for objects in use
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    """ Return the local path of bucket/key, downloading it first if it isn't
+        cached or its ETag changed. The object is marked as in use until
+        release() is called. Pass etag if it's already known (e.g. from a
+        listing) to skip the HEAD request. """
+    def get(self, bucket, key, etag=None):
+        if etag is None:
+            etag = self.s3.head_object(Bucket=bucket, Key=key)['ETag']
+
+        path = os.path.join(self.cache_dir, bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # only one process downloads a given object at a time
+        lock = self._lock_object(path)
+        try:
+            if os.path.exists(path) and self._read_etag(path) == etag:
+                self.hits += 1
+                os.utime(path)      # mark as recently used
+            else:
+                self.misses += 1
+                self._download(bucket, key, etag, path)
+
+            # keep a shared lock while the object is in use so it isn't
+            # evicted. flock drops the exclusive lock before it takes the shared
+            # one, so block evictions until we have it
+            with self._evict_lock(fcntl.LOCK_SH):
+                fcntl.flock(lock, fcntl.LOCK_SH)
+        except Exception:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+            raise
+        self.held[path] = lock
+        self.evict()
+        return path
+
+    """ Mark a path returned by get() as no longer in use. """
+    def release(self, path):
+        lock = self.held.pop(path, None)
+        if lock:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    """ Context manager version of get/release. """
+    @contextmanager
+    def local_copy(self, bucket, key, etag=None):
+        path = self.get(bucket, key, etag)
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+    """ Remove least recently used objects (with their .etag and .lock files)
+        until the cache fits in max_bytes. """
+    def evict(self):
+        with self._evict_lock(fcntl.LOCK_EX):
+            entries = []
+            for root, _, files in os.walk(self.cache_dir):
+                for name in files:
+                    if name.endswith(('.etag', '.lock', '.part')) or name.startswith('.'):
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue    # removed by another process
+                    entries.append((stat.st_mtime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                with open(f"{path}.lock", 'a+') as lock:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue    # in use
+                    for file in (path, f"{path}.etag", f"{path}.lock"):
+                        try:
+                            os.remove(file)
+                        except FileNotFoundError:
+                            pass
+                total -= size
+
+    """ Open the lock file of an object and lock it exclusively. evict() removes
+        the lock file of the objects it removes, so if that happened while we
+        waited for the lock, lock the new file instead. """
+    @staticmethod
+    def _lock_object(path):
+        while True:
+            lock = open(f"{path}.lock", 'a+')
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.samestat(os.fstat(lock.fileno()), os.stat(f"{path}.lock")):
+                    return lock
+            except FileNotFoundError:
+                pass
+            lock.close()
+
+    """ Hold the cache-wide eviction lock: exclusively while evicting, shared
+        while taking the shared lock of an object. """
+    @contextmanager
+    def _evict_lock(self, mode):
+        with open(os.path.join(self.cache_dir, '.evict.lock'), 'a+') as evict_lock:
+            fcntl.flock(evict_lock, mode)
+            yield
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _download(self, bucket, key, etag, path):
+        # download to a temp file first so readers never see a partial object
+        fd, part = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+        os.close(fd)
+        try:
+            self.s3.download_file(bucket, key, part)
+            os.replace(part, path)
+        except Exception:
+            os.remove(part)
+            raise
+        with open(f"{path}.etag", 'w') as file:
+            file.write(etag)
+
+    @staticmethod
+    def _read_etag(path):
+        try:
+            with open(f"{path}.etag") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,38 @@
+from functools import lru_cache
+
+import numpy as np
+
+
+# Bits of the Landsat Collection 2 QA_PIXEL band
+QA_BITS = {
+    'fill': 0,
+    'dilated_cloud': 1,
+    'cirrus': 2,
+    'cloud': 3,
+    'cloud_shadow': 4,
+    'snow': 5,
+    'clear': 6,
+    'water': 7,
+}
+
+
+""" 65536-entry uint8 lookup table that is 1 for every QA_PIXEL value with any
+    of the given flags set. Tables are cached per set of flags. """
+@lru_cache(maxsize=None)
+def qa_lut(flags):
+    unknown = set(flags) - set(QA_BITS)
+    if unknown:
+        raise ValueError(f"unknown QA flags: {', '.join(sorted(unknown))}")
+
+    bit_mask = 0
+    for flag in flags:
+        bit_mask |= 1 << QA_BITS[flag]
+    codes = np.arange(2**16, dtype=np.uint16)
+    return (np.bitwise_and(codes, bit_mask) != 0).astype(np.uint8)
+
+
+""" Decode a QA_PIXEL band (or block of it) into a uint8 mask that is 1 where
+    any of the given flags (names from QA_BITS) is set, with a single lookup. """
+def decode_qa(qa, flags, out=None):
+    lut = qa_lut(frozenset(flags))
+    return lut.take(qa, out=out)
@@ -0,0 +1,73 @@
+import json
+import sqlite3
+import time
+
+
+""" Local SQLite record of what has been processed, so batch re-runs only touch
+    new or changed work and can resume after a crash.
+
+    There is one row per (input key, product), e.g. one for each of the VV, VH
+    and INC outputs of an S1 granule, with the input's ETag, the processing
+    parameters, the output key and a status. A product needs (re)processing if
+    it has no row, didn't finish, or its input ETag or parameters changed, so
+    changing e.g. the Lee window size only invalidates the VV/VH outputs.
+    Several processes can share one ledger file. """
+class Ledger:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS outputs (
+                input_key TEXT NOT NULL,
+                product TEXT NOT NULL,
+                etag TEXT NOT NULL,
+                params TEXT NOT NULL,
+                output_key TEXT,
+                status TEXT NOT NULL,
+                error TEXT,
+                updated REAL NOT NULL,
+                PRIMARY KEY (input_key, product)
+            )""")
+
+    """ Given an input key, its current ETag and a dict of product -> parameters,
+        return the products that need (re)processing. """
+    def pending(self, input_key, etag, products):
+        rows = self.conn.execute(
+            "SELECT product, etag, params, status FROM outputs WHERE input_key = ?", (input_key,))
+        done = {product for product, row_etag, params, status in rows
+                if status == 'done' and row_etag == etag and params == self._dump(products.get(product))}
+        return [product for product in products if product not in done]
+
+    """ Record that processing of a product has started. """
+    def start(self, input_key, etag, product, params):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO outputs (input_key, product, etag, params, output_key, status, error, updated) "
+            "VALUES (?, ?, ?, ?, NULL, 'running', NULL, ?)",
+            (input_key, product, etag, self._dump(params), time.time()))
+
+    """ Record that a product finished and was written to output_key. """
+    def finish(self, input_key, product, output_key):
+        self.conn.execute(
+            "UPDATE outputs SET status = 'done', output_key = ?, updated = ? WHERE input_key = ? AND product = ?",
+            (output_key, time.time(), input_key, product))
+
+    """ Record that processing of a product failed. """
+    def fail(self, input_key, product, error):
+        self.conn.execute(
+            "UPDATE outputs SET status = 'failed', error = ?, updated = ? WHERE input_key = ? AND product = ?",
+            (str(error), time.time(), input_key, product))
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def _dump(params):
+        return json.dumps(params, sort_keys=True)
+
+
+""" List every object under a prefix (following pagination) as (key, etag) pairs. """
+def list_objects(s3, bucket, prefix):
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj['Key'], obj['ETag']
@@ -0,0 +1,77 @@
+import io
+import os
+
+from osgeo import gdal
+from boto3.s3.transfer import TransferConfig
+
+
+# outputs up to this size (uncompressed) are written to /vsimem instead of local
+# disk. Set MAX_MEM_OUTPUT_MB to change it, e.g. for lambdas with more memory
+max_mem_output_bytes = int(os.environ.get("MAX_MEM_OUTPUT_MB", 512)) * 2**20
+
+# large outputs are uploaded in 16 MB parts, streamed from memory or disk
+transfer_config = TransferConfig(multipart_threshold=16 * 2**20, multipart_chunksize=16 * 2**20)
+
+
+""" Return the path to write an output file of roughly nbytes (uncompressed) to:
+    a /vsimem path if it fits within max_bytes (default: max_mem_output_bytes),
+    otherwise name on local disk. """
+def output_path(name, nbytes, max_bytes=None):
+    if max_bytes is None:
+        max_bytes = max_mem_output_bytes
+    if nbytes <= max_bytes:
+        return f"/vsimem/{name}"
+    return name
+
+
+""" Read-only file object over a GDAL virtual file (e.g. in /vsimem), so it can
+    be streamed to s3 without a copy on local disk. """
+class VSIFile(io.RawIOBase):
+    def __init__(self, path):
+        self.path = path
+        self.fp = gdal.VSIFOpenL(path, 'rb')
+        if self.fp is None:
+            raise FileNotFoundError(path)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = gdal.VSIFReadL(1, len(buffer), self.fp)
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        gdal.VSIFSeekL(self.fp, offset, whence)
+        return self.tell()
+
+    def tell(self):
+        return gdal.VSIFTellL(self.fp)
+
+    def close(self):
+        if self.fp is not None:
+            gdal.VSIFCloseL(self.fp)
+            self.fp = None
+        super().close()
+
+
+""" Remove an output file, in /vsimem or on local disk. """
+def remove_output(path):
+    if path.startswith("/vsimem/"):
+        gdal.Unlink(path)
+    else:
+        os.remove(path)
+
+
+""" Upload an output file (see output_path) to s3, using a multipart upload for
+    large files, and remove it. """
+def upload_output(path, bucket, key, s3):
+    if path.startswith("/vsimem/"):
+        with VSIFile(path) as file:
+            s3.upload_fileobj(file, bucket, key, Config=transfer_config)
+    else:
+        s3.upload_file(path, bucket, key, Config=transfer_config)
+    remove_output(path)
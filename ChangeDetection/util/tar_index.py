@@ -0,0 +1,102 @@
+import io
+import json
+import tarfile
+
+import botocore
+
+
+""" Index of the members of tar files in s3, so GDAL can read a member with a
+    single byte range (/vsisubfile) instead of walking the tar headers over
+    HTTP (/vsitar) every time the tar is opened.
+
+    The index maps member name -> (data offset, size) and is stored as a small
+    JSON object next to the tar ({key}.index.json), along with the tar's ETag
+    so a replaced tar gets a new index. """
+INDEX_SUFFIX = ".index.json"
+
+
+""" Read-only, seekable file object over an s3 object that fetches byte ranges
+    on demand, so tarfile only downloads the headers it reads. """
+class S3RangeFile(io.RawIOBase):
+    def __init__(self, s3, bucket, key):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        head = s3.head_object(Bucket=bucket, Key=key)
+        self.size = head['ContentLength']
+        self.etag = head['ETag']
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        else:
+            self.pos = self.size + offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def readinto(self, buffer):
+        end = min(self.pos + len(buffer), self.size)
+        if end <= self.pos:
+            return 0
+        response = self.s3.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={self.pos}-{end - 1}",
+                                      IfMatch=self.etag)
+        data = response['Body'].read()
+        buffer[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+
+""" Build the member index of a tar in s3 by reading its headers (one small
+    range request per member). """
+def build_tar_index(s3, bucket, key):
+    file = S3RangeFile(s3, bucket, key)
+    members = {}
+    with tarfile.open(fileobj=file, mode='r:') as tar:
+        for member in tar:
+            if member.isfile():
+                name = member.name[2:] if member.name.startswith("./") else member.name
+                members[name] = (member.offset_data, member.size)
+    return {'etag': file.etag, 'members': members}
+
+
+""" Return the member index of a tar in s3, building it and storing it next to
+    the tar if there isn't one yet or the tar changed. Pass etag if it's
+    already known (e.g. from a listing) to skip a HEAD request. """
+def get_tar_index(s3, bucket, key, etag=None):
+    index_key = f"{key}{INDEX_SUFFIX}"
+    try:
+        index = json.loads(s3.get_object(Bucket=bucket, Key=index_key)['Body'].read())
+        if etag is None:
+            etag = s3.head_object(Bucket=bucket, Key=key)['ETag']
+        # listings quote ETags, s3 event notifications don't
+        if index['etag'].strip('"') == etag.strip('"'):
+            return index
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] not in ("NoSuchKey", "404"):
+            raise e
+
+    index = build_tar_index(s3, bucket, key)
+    try:
+        s3.put_object(Bucket=bucket, Key=index_key, Body=json.dumps(index).encode(),
+                      ContentType="application/json")
+    except botocore.exceptions.ClientError as e:
+        # still usable for this run, just not stored
+        print(f"Could not store tar index {bucket}/{index_key}: {e}")
+    return index
+
+
+""" GDAL path of a member of an (indexed) tar, read as a single byte range. """
+def member_path(tar_path, index, name):
+    offset, size = index['members'][name]
+    return f"/vsisubfile/{offset}_{size},{tar_path}"